@@ -0,0 +1,268 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import logging
+import time
+from collections import namedtuple
+
+import usb.core
+
+from .events import PollingEventSource
+from .power import _CURRENT_MAPPING
+
+POLICIES = ['limit', 'disable', 'both']
+
+## 'action' is one of 'limit', 'disable', 'restore_limit', 'enable' or 'exhausted'.  
+## 'value' is the new limit in mA for limit actions, otherwise the port current in mA.
+## 'total' and 'headroom' are in mA, as measured when the decision was made.
+BudgetDecision = namedtuple('BudgetDecision', ['timestamp', 'key', 'port', 'action', 'value', 'total', 'headroom', 'reason'])
+
+class PowerBudget(PollingEventSource):
+    """Keeps the total current drawn across the ports of many Hubs under a supply budget.
+
+    Each step measures every port, and when the total exceeds 'budget' (mA) 
+    sheds load from the lowest priority ports first -- by stepping their current 
+    limit down ('limit' policy), by turning them off ('disable' policy), or by 
+    limiting and turning off ports whose limit cannot be lowered further ('both').
+    Shed ports are restored, highest priority first, one per step once the 
+    total is below 'budget * (1 - hysteresis)' and the restored port is not 
+    expected to push it back above that.  Ports are not acted on again within 
+    'hold' seconds of the last action.
+
+    Hubs only need 'key' and a 'power' attribute with 'measurements', 'state', 
+    'limits', 'set_limits', 'enable' and 'disable' methods, so the controller 
+    can be exercised against simulated Hubs.  Decisions are logged, kept in 
+    'decisions', and emitted as BudgetDecision events.
+    """
+
+    name = "usbhub-power-budget"
+
+    def __init__(self, devices, budget, rate=5, priorities=None, policy='limit', 
+                 hysteresis=0.1, hold=2.0, min_limit=_CURRENT_MAPPING[0], history=1024, queue_size=1024):
+        super().__init__(1.0 / float(rate), queue_size=queue_size)
+
+        if policy not in POLICIES:
+            raise ValueError("Policy must be one of {}".format(", ".join(POLICIES)))
+
+        if min_limit not in _CURRENT_MAPPING:
+            raise ValueError("Specified current limit of {} is not valid. Limits can be: {}".format(min_limit, _CURRENT_MAPPING))
+
+        if not isinstance(devices, (list, tuple)):
+            devices = [devices]
+
+        self.devices = {device.key:device for device in devices}
+        self.budget = float(budget)
+        self.policy = policy
+        self.hysteresis = hysteresis
+        self.hold = hold
+        self.min_limit = min_limit
+
+        ## Priority of each (key, port) pair, higher values are shed last.  Ports not listed are priority 0.
+        self.priorities = dict(priorities or {})
+
+        self.decisions = collections.deque(maxlen=history)
+
+        self.total = None
+        self.currents = {}
+
+        ## Limits when the controller first saw each Hub, which restores return to
+        self._original = {}
+        self._limits = {}
+        self._state = {}
+
+        ## (key, port) -> current in mA when the port was disabled
+        self._disabled = {}
+        self._last_action = {}
+
+    @property
+    def headroom(self):
+        if self.total is None:
+            return None
+
+        return self.budget - self.total
+
+    def _priority(self, key, port):
+        return self.priorities.get((key, port), 0)
+
+    def _measure(self):
+        for key, device in self.devices.items():
+            try:
+                if key not in self._original:
+                    self._original[key] = list(device.power.limits())
+                    self._limits[key] = list(self._original[key])
+
+                self.currents[key] = list(device.power.measurements())
+                self._state[key] = list(device.power.state())
+            except (usb.core.USBError, OSError) as e:
+                ## Keep using the previous readings of this Hub, if there are any
+                logging.warn("Power budget could not measure Hub {} : {}".format(key, e))
+
+        total = 0
+        for key, currents in self.currents.items():
+            total += sum(current for port, current in enumerate(currents, 1) if self._state[key][port-1])
+
+        self.total = total
+        return total
+
+    def _decide(self, now, key, port, action, value, reason):
+        decision = BudgetDecision(now, key, port, action, value, self.total, self.headroom, reason)
+        self.decisions.append(decision)
+        logging.info("Power budget : {} Hub {} port {} ({}) : {}".format(action, key, port, value, reason))
+
+        if port is not None:
+            self._last_action[(key, port)] = now
+
+        return decision
+
+    def _held(self, now, key, port):
+        last = self._last_action.get((key, port))
+        return last is not None and now - last < self.hold
+
+    def _candidates(self):
+        ## Ports eligible for shedding, lowest priority and then highest current first
+        out = []
+
+        for key, currents in self.currents.items():
+            for port, current in enumerate(currents, 1):
+                if self._state[key][port-1]:
+                    out.append((self._priority(key, port), -current, key, port))
+
+        return [(key, port) for _, _, key, port in sorted(out)]
+
+    def _shed(self, now, excess):
+        found = []
+
+        for key, port in self._candidates():
+            if excess <= 0:
+                break
+
+            if self._held(now, key, port):
+                continue
+
+            device = self.devices[key]
+            current = self.currents[key][port-1]
+            setting = _CURRENT_MAPPING.index(self._limits[key][port-1])
+
+            ## Step the limit down as far as needed to cover the excess, but no further.  
+            ## Lowering a limit only sheds load when the port draws more than the new limit.
+            lower = [value for value in _CURRENT_MAPPING[:setting] if value >= self.min_limit]
+            fits = [value for value in lower if value <= current - excess]
+            new_limit = max(fits) if len(fits) > 0 else self.min_limit
+
+            if self.policy != 'disable' and len(lower) > 0 and current > new_limit:
+                device.power.set_limits([port], new_limit)
+                self._limits[key][port-1] = new_limit
+
+                excess -= max(0, current - new_limit)
+                found.append(self._decide(now, key, port, 'limit', new_limit, "over budget by {:.0f} mA".format(self.total - self.budget)))
+
+            elif self.policy != 'limit' and current > 0:
+                device.power.disable([port])
+                self._state[key][port-1] = False
+                self._disabled[(key, port)] = current
+
+                excess -= current
+                found.append(self._decide(now, key, port, 'disable', current, "over budget by {:.0f} mA".format(self.total - self.budget)))
+
+        ## Only report running out of options once, rather than on every step
+        exhausted = len(self.decisions) > 0 and self.decisions[-1].action == 'exhausted'
+
+        if excess > 0 and len(found) == 0 and not exhausted:
+            found.append(self._decide(now, None, None, 'exhausted', None, "over budget with nothing left to shed"))
+
+        return found
+
+    def _restorable(self):
+        ## Shed ports, highest priority first, as (priority, key, port, kind, expected increase in mA)
+        out = []
+
+        for (key, port), current in self._disabled.items():
+            out.append((self._priority(key, port), key, port, 'enable', current))
+
+        for key, limits in self._limits.items():
+            for port, limit in enumerate(limits, 1):
+                if limit < self._original[key][port-1] and (key, port) not in self._disabled:
+                    setting = _CURRENT_MAPPING.index(limit)
+                    out.append((self._priority(key, port), key, port, 'restore_limit', _CURRENT_MAPPING[setting+1] - limit))
+
+        return sorted(out, key=lambda entry: -entry[0])
+
+    def _restore(self, now, low):
+        for _, key, port, kind, increase in self._restorable():
+            if self._held(now, key, port) or self.total + increase >= low:
+                continue
+
+            device = self.devices[key]
+
+            if kind == 'enable':
+                device.power.enable([port])
+                self._state[key][port-1] = True
+                del self._disabled[(key, port)]
+                return [self._decide(now, key, port, 'enable', increase, "headroom {:.0f} mA".format(self.headroom))]
+
+            new_limit = _CURRENT_MAPPING[_CURRENT_MAPPING.index(self._limits[key][port-1]) + 1]
+            device.power.set_limits([port], new_limit)
+            self._limits[key][port-1] = new_limit
+            return [self._decide(now, key, port, 'restore_limit', new_limit, "headroom {:.0f} mA".format(self.headroom))]
+
+        return []
+
+    def step(self, now=None):
+        """Run one measure / decide / act cycle and return the BudgetDecisions made."""
+        if now is None:
+            now = time.monotonic()
+
+        total = self._measure()
+
+        if total > self.budget:
+            return self._shed(now, total - self.budget)
+
+        if total < self.budget * (1 - self.hysteresis):
+            return self._restore(now, self.budget * (1 - self.hysteresis))
+
+        return []
+
+    def release(self):
+        """Restore all original limits and re-enable every port the controller disabled."""
+        for key, limits in self._limits.items():
+            for port, limit in enumerate(limits, 1):
+                if limit != self._original[key][port-1]:
+                    self.devices[key].power.set_limits([port], self._original[key][port-1])
+
+            self._limits[key] = list(self._original[key])
+
+        for key, port in list(self._disabled.keys()):
+            self.devices[key].power.enable([port])
+            del self._disabled[(key, port)]
+
+    def poll(self):
+        try:
+            found = self.step()
+        except (usb.core.USBError, OSError) as e:
+            logging.warn("Power budget step failed : {}".format(e))
+            return []
+
+        for decision in found:
+            self._emit(decision)
+
+        return found
@@ -21,7 +21,10 @@
 # THE SOFTWARE.
 
 import logging
+import math
+import threading
 import time
+from collections import namedtuple
 
 import usb.core
 import usb.util
@@ -43,6 +46,35 @@ _CMD_RESET  = 0b111
 
 _WAIT = 0.1
 
+## A mailbox request the firmware has taken is presumed lost once its reply is
+## this many times later than the typical round trip.  Until a round trip has been
+## measured, _STALL_DEFAULT seconds is used instead.
+_STALL_FACTOR = 3
+_STALL_DEFAULT = 0.5
+
+## Mailbox polling policy.  'spin' polls are made back-to-back, then the delay 
+## between polls starts at 'initial' seconds and grows by 'factor' up to 'maximum'.
+MailboxPolling = namedtuple('MailboxPolling', ['spin', 'initial', 'factor', 'maximum'])
+
+POLLING_ADAPTIVE = MailboxPolling(spin=2, initial=0.002, factor=2.0, maximum=_WAIT)
+POLLING_FIXED    = MailboxPolling(spin=0, initial=_WAIT, factor=1.0, maximum=_WAIT)
+
+## Seconds a mailbox operation may wait for the firmware before giving up.  
+## Applies to every USBHubConfig which does not set its own 'timeout'.
+DEFAULT_TIMEOUT = 5.0
+
+def set_default_timeout(seconds):
+    global DEFAULT_TIMEOUT
+    DEFAULT_TIMEOUT = seconds
+
+class MailboxTimeoutError(TimeoutError):
+    """Raised when the Hub firmware does not service the config mailbox in time."""
+
+    def __init__(self, operation, waited):
+        super().__init__("Config mailbox {} timed out after {:.3f} s".format(operation, waited))
+        self.operation = operation
+        self.waited = waited
+
 _NAME_RO = [
     'power_errors',
     'power_measure_12',
@@ -60,7 +92,18 @@ _NAME_ADDR = dict(
     external_heartbeat  = 0x12,
 )
 
-def _generate_crc(data):
+_ADDR_NAME = {addr:name for name, addr in _NAME_ADDR.items()}
+
+## Seconds a cached parameter value stays valid when the config cache is enabled.
+## Parameters not listed here (and all read-only ones) are always fetched.
+_CACHE_TTL = dict(
+    power_limits        = 60.0,
+    highspeed_disable   = 60.0,
+    loop_delay          = 60.0,
+    external_heartbeat  = 60.0,
+)
+
+def _generate_crc_bitwise(data):
     crc = _CRC8_INIT
 
     for byte in data:
@@ -73,12 +116,63 @@ def _generate_crc(data):
 
     return crc & 0xFF
 
+def _build_crc_table():
+    ## Entry N is the CRC register after shifting byte N through it from a zero
+    ## state.  Seeding the bitwise routine with N ^ _CRC8_INIT cancels its
+    ## initial value, so the table follows from the reference implementation.
+    return bytes([_generate_crc_bitwise([value ^ _CRC8_INIT]) for value in range(256)])
+
+_CRC8_TABLE = _build_crc_table()
+
+def _generate_crc(data):
+    crc = _CRC8_INIT
+
+    for byte in data:
+        crc = _CRC8_TABLE[crc ^ byte]
+
+    return crc
+
+## Mailbox frames are [cmd << 5 | name, value MSB, value LSB, CRC]
+_EMPTY_FRAME = bytes(4)
+
+def _encode_frame(cmd, name_addr, value):
+    head = cmd << 5 | name_addr
+    msb = (value >> 8) & 0xFF
+    lsb = value & 0xFF
+
+    return bytes((head, msb, lsb, _CRC8_TABLE[_CRC8_TABLE[_CRC8_TABLE[_CRC8_INIT ^ head] ^ msb] ^ lsb]))
+
+def _decode_frame(buf):
+    ## Returns (cmd, name address, value), or None if the CRC does not match
+    if _CRC8_TABLE[_CRC8_TABLE[_CRC8_TABLE[_CRC8_INIT ^ buf[0]] ^ buf[1]] ^ buf[2]] != buf[3]:
+        return None
+
+    return buf[0] >> 5, buf[0] & 0b11111, buf[1] << 8 | buf[2]
+
 class USBHubConfig:
 
-    def __init__(self, hub, clear=False):
+    def __init__(self, hub, clear=False, polling=POLLING_ADAPTIVE, timeout=None, cache=False):
         self.hub = hub
         self._version = None
 
+        self.polling = polling
+        self.timeout = timeout
+
+        ## Values of rarely-changing parameters, as name : (value, expiry time)
+        self.cache = cache
+        self.cache_ttl = dict(_CACHE_TTL)
+        self._cache = {}
+
+        ## Seconds between the last command being written and its reply arriving
+        self.turnaround = None
+
+        ## Running average of command round trips, used to spot lost replies
+        self._round_trip = None
+
+        ## The mailbox holds one command and one reply, so a command and the
+        ## read of its reply must not interleave with those of another thread.
+        self._lock = threading.RLock()
+
         if clear:
             self.clear()
 
@@ -100,13 +194,12 @@ class USBHubConfig:
 
     def _read(self):
         buf, _ = self.hub.register_read(addr=_MEM_READ, length=4)
-        crc = _generate_crc(buf[0:3])
+        frame = _decode_frame(buf)
 
-        if crc == buf[3]:
-            self.hub.register_write(addr=_MEM_READ, buf=[0,0,0,0])
-            return buf[0:3]
-        
-        return None
+        if frame is not None:
+            self.hub.register_write(addr=_MEM_READ, buf=_EMPTY_FRAME)
+
+        return frame
 
     def _write_okay(self):
         buf, _ = self.hub.register_read(addr=_MEM_WRITE, length=4)
@@ -116,24 +209,108 @@ class USBHubConfig:
 
         return False
 
-    def _write(self, buf):    
-        crc = _generate_crc(buf[0:3])
-        buf = buf[0:3] + [crc]
-        return self.hub.register_write(addr=_MEM_WRITE, buf=buf)
+    def _write(self, cmd, name_addr, value):    
+        return self.hub.register_write(addr=_MEM_WRITE, buf=_encode_frame(cmd, name_addr, value))
 
     def read(self):
-        buf   = self._read()
+        with self._lock:
+            frame = self._read()
 
-        if buf is None:
+        if frame is None:
             return _CMD_NOOP, None, None
 
-        cmd   = buf[0] >> 5
-        name  = buf[0] & 0b11111
-        value = buf[1] << 8 | buf[2]
+        return frame
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+
+        return time.monotonic(), time.monotonic() + timeout
+
+    def _timed_out(self, operation, start):
+        ## An abandoned set may or may not have been applied
+        self.invalidate()
+
+        ## Leave the mailbox empty so the next command does not pick up a
+        ## stale request or reply from the one which was abandoned.
+        try:
+            self.clear()
+        except (usb.core.USBError, OSError):
+            logging.warn("Unable to clear config mailbox after timeout")
+
+        error = MailboxTimeoutError(operation, time.monotonic() - start)
+        logging.error(str(error))
+        raise error
+
+    def _cache_get(self, name):
+        if not self.cache or name not in self._cache:
+            return None
+
+        value, expiry = self._cache[name]
+
+        if time.monotonic() >= expiry:
+            del self._cache[name]
+            return None
+
+        return value
+
+    def _cache_put(self, name, value):
+        if not self.cache or name in _NAME_RO or self.cache_ttl.get(name) is None:
+            return
+
+        self._cache[name] = (value, time.monotonic() + self.cache_ttl[name])
 
-        return cmd, name, value
+    def invalidate(self, name=None):
+        """Drop one (or every) cached parameter value so the next read fetches it from the Hub."""
+        if name is None:
+            self._cache = {}
+        else:
+            self._cache.pop(name, None)
+
+    def _poll(self, check, polling=None, deadline=None, operation="poll"):
+        ## Call 'check' until it returns something other than None, 
+        ## waiting between attempts according to the polling policy.
+        if polling is None:
+            polling = self.polling
+
+        if deadline is None:
+            deadline = self._deadline(None)
+
+        start, end = deadline
+        spins = polling.spin
+        delay = polling.initial
+
+        while True:
+            result = check()
 
-    def write(self, cmd, name=None, value=0):
+            if result is not None:
+                return result
+
+            remaining = end - time.monotonic()
+
+            if remaining <= 0:
+                self._timed_out(operation, start)
+
+            if spins > 0:
+                spins -= 1
+                continue
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * polling.factor, polling.maximum)
+
+    def _reply(self, cmd, name_addr):
+        out = self.read()
+
+        ## Replies echo the parameter name, so a stale reply to another request is discarded
+        if out[0] == cmd and out[1] == name_addr:
+            return out
+
+        return None
+
+    def write(self, cmd, name=None, value=0, polling=None, timeout=None, deadline=None):
         if name is None:
             name_addr = 0
         else:
@@ -142,14 +319,257 @@ class USBHubConfig:
         if name_addr > 0b11111:
             logging.error("Address of name '{}' is above 5 bit limit".format(name))
 
-        while not self._write_okay():
-            time.sleep(_WAIT)
+        if deadline is None:
+            deadline = self._deadline(timeout)
+
+        with self._lock:
+            self._poll(lambda: True if self._write_okay() else None, polling, deadline, "write")
+            self._write(cmd, name_addr, value)
+
+    def _transaction(self, cmd, name=None, value=0, polling=None, timeout=None):
+        name_addr = 0 if name is None else _NAME_ADDR[name]
+
+        with self._lock:
+            deadline = self._deadline(timeout)
+            self.write(cmd, name=name, value=value, polling=polling, deadline=deadline)
+
+            start = time.monotonic()
+            out = self._poll(lambda: self._reply(cmd, name_addr), polling, deadline, "reply")
+            self.turnaround = time.monotonic() - start
+            self._observe(self.turnaround)
+
+        return out
+
+    def _observe(self, seconds):
+        if self._round_trip is None:
+            self._round_trip = seconds
+        else:
+            self._round_trip += 0.25 * (seconds - self._round_trip)
+
+    def _stall_time(self, polling):
+        if self._round_trip is None:
+            return _STALL_DEFAULT
+
+        return max(_STALL_FACTOR * self._round_trip, polling.maximum)
+
+    def _session(self, cmd, requests, polling=None, timeout=None):
+        ## Issue several commands through the mailbox, writing each one as soon as
+        ## the firmware has taken the previous from _MEM_WRITE rather than waiting
+        ## for its reply.  Replies are matched to requests by parameter name.
+        ##
+        ## _MEM_READ holds a single reply, so if a reply for a later request shows
+        ## up while earlier ones are outstanding, those earlier replies were
+        ## overwritten before they could be read and the requests are re-sent.
+        ##
+        ## A reply can also land between reading _MEM_READ and clearing it, and 
+        ## be wiped by the clear.  When that was the last outstanding reply no
+        ## later reply reveals the loss, so a request is also re-sent once the
+        ## firmware has taken it from _MEM_WRITE and its reply is well overdue
+        ## compared to the measured round trip.
+        with self._lock:
+            if polling is None:
+                polling = self.polling
+
+            names = set(name for name, _ in requests)
+            pending = list(requests)
+            results = {}
+
+            ## Entries are [name, value, time written, time seen taken by the firmware]
+            outstanding = []
+
+            writes = 0
+            replies = 0
+            resent = False
+
+            spins = polling.spin
+            delay = polling.initial
+            start, end = self._deadline(timeout)
+
+            while len(pending) > 0 or len(outstanding) > 0:
+                wrote = False
+                replied = False
+
+                ## Whether the firmware has taken the last request only matters once
+                ## its reply is overdue, so skip that extra transfer until then
+                stall = self._stall_time(polling)
+                overdue = len(outstanding) > 0 and outstanding[-1][3] is None and \
+                    time.monotonic() - outstanding[-1][2] > stall
+
+                if (len(pending) > 0 or overdue) and self._write_okay():
+                    ## _MEM_WRITE holds one command, so every request written so far has been taken
+                    now = time.monotonic()
+                    for entry in outstanding:
+                        if entry[3] is None:
+                            entry[3] = now
+
+                    if len(pending) > 0:
+                        name, value = pending.pop(0)
+                        self._write(cmd, _NAME_ADDR[name], value)
+                        outstanding.append([name, value, time.monotonic(), None])
+                        writes += 1
+                        wrote = True
+
+                if len(outstanding) > 0:
+                    reply, addr, value = self.read()
+
+                    if reply == cmd and _ADDR_NAME.get(addr) in names:
+                        replies += 1
+                        waiting = [entry[0] for entry in outstanding]
+
+                        ## Replies to requests which were sent twice are only counted
+                        if _ADDR_NAME[addr] in waiting:
+                            idx = waiting.index(_ADDR_NAME[addr])
+                            results[waiting[idx]] = value
+                            self._observe(time.monotonic() - outstanding[idx][2])
+
+                            pending = [(entry[0], entry[1]) for entry in outstanding[:idx]] + pending
+                            outstanding = outstanding[idx+1:]
+                            replied = True
+
+                now = time.monotonic()
+                lost = [entry for entry in outstanding if entry[3] is not None and now - entry[3] > stall]
+
+                if len(lost) > 0:
+                    pending = [(entry[0], entry[1]) for entry in lost] + pending
+                    outstanding = [entry for entry in outstanding if entry not in lost]
+                    resent = True
+
+                remaining = end - now
+
+                if remaining <= 0:
+                    self._timed_out("session", start)
+
+                if replied or wrote:
+                    spins = polling.spin
+                    delay = polling.initial
+                    continue
+
+                if spins > 0:
+                    spins -= 1
+                else:
+                    time.sleep(min(delay, remaining))
+                    delay = min(delay * polling.factor, polling.maximum)
+
+            ## A request presumed lost may only have been slow, in which case its
+            ## second copy is still queued or being handled.  Wait for that copy to
+            ## be taken and answered, so its reply is not picked up by a later command.
+            if resent and writes > replies:
+                self._poll(lambda: True if self._write_okay() else None, polling, (start, end), "session")
+
+                settle = time.monotonic() + self._stall_time(polling)
+                delay = polling.initial
+
+                while replies < writes and time.monotonic() < settle:
+                    reply, addr, _ = self.read()
+
+                    if reply == cmd and _ADDR_NAME.get(addr) in names:
+                        replies += 1
+                    else:
+                        time.sleep(delay)
+                        delay = min(delay * polling.factor, polling.maximum)
+
+            self.turnaround = time.monotonic() - start
+            return results
+
+    def get_many(self, names, polling=None, timeout=None):
+        """Read several parameters in one mailbox session, returning a dict of name to value."""
+        results = {}
+        requests = []
+
+        for name in dict.fromkeys(names):
+            value = self._cache_get(name)
+
+            if value is None:
+                requests.append((name, 0))
+            else:
+                results[name] = value
+
+        if len(requests) > 0:
+            for name, value in self._session(_CMD_GET, requests, polling, timeout).items():
+                self._cache_put(name, value)
+                results[name] = value
+
+        return results
+
+    def set_many(self, values, polling=None, timeout=None):
+        """Write a dict of parameter values in one mailbox session, returning the values echoed back."""
+        for name in values.keys():
+            if name in _NAME_RO:
+                raise ValueError("Cannot set read-only parameter '{}'".format(name))
+
+        results = self._session(_CMD_SET, list(values.items()), polling, timeout)
+
+        for name, value in results.items():
+            self._cache_put(name, value)
 
-        self._write([cmd << 5 | name_addr, (value >> 8) & 0xFF, value & 0xFF])
+        return results
+
+    def measure_turnaround(self, name="data_state", count=20, polling=None, timeout=None):
+        """Time 'count' mailbox reads of a parameter, returning min / median / mean / max round trip and jitter in seconds."""
+        samples = []
+
+        for _ in range(count):
+            start = time.monotonic()
+
+            ## Bypass the cache, as it is the firmware being measured
+            self._transaction(_CMD_GET, name=name, polling=polling, timeout=timeout)
+            samples.append(time.monotonic() - start)
+
+        samples.sort()
+        mean = sum(samples) / len(samples)
+
+        return dict(
+            min    = samples[0],
+            median = samples[len(samples) // 2],
+            mean   = mean,
+            max    = samples[-1],
+            jitter = math.sqrt(sum((value - mean) ** 2 for value in samples) / len(samples)),
+        )
+
+    def tune_loop_delay(self, values=[0, 1, 2, 5, 10, 20, 50], count=20, max_jitter=None, apply=False, settle=0.5, timeout=1.0):
+        """Measure mailbox latency at each firmware 'loop_delay' value and find the lowest stable one.
+
+        A value is stable when every measured read completes within 'timeout' seconds and,
+        if 'max_jitter' (seconds) is given, the round trip jitter is below it.  
+        With 'apply' the recommended value is left active (use 'save' to persist
+        it); otherwise the original value is restored.  Returns the original and 
+        recommended values and the per-value latency / jitter profile.
+        """
+        ## Only the measured reads use 'timeout'; changing the parameter uses the 
+        ## normal mailbox deadline so that an unstable setting can still be undone.
+        original = self.get("loop_delay")
+        profile = []
+
+        try:
+            for value in sorted(values):
+                self.set("loop_delay", value)
+                time.sleep(settle)
+
+                entry = dict(loop_delay=value, stable=False)
+
+                try:
+                    entry.update(self.measure_turnaround(name="power_measure_12", count=count, timeout=timeout))
+                    entry['stable'] = max_jitter is None or entry['jitter'] <= max_jitter
+                except MailboxTimeoutError as error:
+                    entry['error'] = str(error)
+
+                logging.debug("loop_delay {} : {}".format(value, entry))
+                profile.append(entry)
+        finally:
+            stable = [entry['loop_delay'] for entry in profile if entry['stable']]
+            recommended = stable[0] if len(stable) > 0 else None
+
+            if apply and recommended is not None:
+                self.set("loop_delay", recommended)
+            else:
+                self.set("loop_delay", original)
+
+        return dict(original=original, recommended=recommended, profile=profile)
 
     def clear(self):
-        self.hub.register_write(addr=_MEM_READ,  buf=[0,0,0,0])
-        self.hub.register_write(addr=_MEM_WRITE, buf=[0,0,0,0])
+        with self._lock:
+            self.hub.register_write(addr=_MEM_READ,  buf=_EMPTY_FRAME)
+            self.hub.register_write(addr=_MEM_WRITE, buf=_EMPTY_FRAME)
 
     def device_info(self):
         return dict(
@@ -157,23 +577,21 @@ class USBHubConfig:
             circuitpython = self.circuitpython_version.split(".")
         )
 
-    def reset(self, target="usb"):
+    def reset(self, target="usb", timeout=None):
         targets = ["usb", "mcu", "bootloader"]
-        self.write(_CMD_RESET, value=targets.index(target))
+        self.write(_CMD_RESET, value=targets.index(target), timeout=timeout)
+
+        ## Firmware reloads its parameters on reset
+        self.invalidate()
 
-    def save(self):
+    def save(self, polling=None, timeout=None):
         info = self.device_info()
 
         if info["circuitpython"][0] == 5 and info["circuitpython"][1] < 2:
             logging.error("MCU must be upgraded to CircuitPython 5.2.0 or newer for filesystem saves to work.")
             return
 
-        self.write(_CMD_SAVE)
-
-        out = self.read()
-        while out[0] != _CMD_SAVE:
-            time.sleep(_WAIT)
-            out = self.read()
+        out = self._transaction(_CMD_SAVE, polling=polling, timeout=timeout)
 
         if out[2] == 0:
             logging.error("Save of the config.ini file failed.")
@@ -181,25 +599,22 @@ class USBHubConfig:
 
         return out[2]
 
-    def get(self, name):
-        self.write(_CMD_GET, name=name)
+    def get(self, name, polling=None, timeout=None):
+        value = self._cache_get(name)
 
-        out = self.read()
-        while out[0] != _CMD_GET:
-            time.sleep(_WAIT)
-            out = self.read()
+        if value is not None:
+            return value
+
+        out = self._transaction(_CMD_GET, name=name, polling=polling, timeout=timeout)
+        self._cache_put(name, out[2])
 
         return out[2]
 
-    def set(self, name, value):
+    def set(self, name, value, polling=None, timeout=None):
         if name in _NAME_RO:
             raise ValueError("Cannot set read-only parameter '{}'".format(name))
 
-        self.write(_CMD_SET, name=name, value=value)
-
-        out = self.read()
-        while out[0] != _CMD_SET:
-            time.sleep(_WAIT)
-            out = self.read()
+        out = self._transaction(_CMD_SET, name=name, value=value, polling=polling, timeout=timeout)
+        self._cache_put(name, out[2])
 
         return out[2]
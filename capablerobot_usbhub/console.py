@@ -36,8 +36,12 @@ import usb
 if __name__ == '__main__' and __package__ is None:
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
     from capablerobot_usbhub.main import USBHub
+    from capablerobot_usbhub.recorder import TelemetryRecorder, TelemetryReader
+    from capablerobot_usbhub.scheduler import PortScheduler, jitter_report
 else:
     from .main import USBHub
+    from .recorder import TelemetryRecorder, TelemetryReader
+    from .scheduler import PortScheduler, jitter_report
 
 
 
@@ -45,6 +49,19 @@ COL_WIDTH = 12
 PORTS = ["Port {}".format(num) for num in [1,2,3,4]]
 
 
+def _wait_for_ports(ports, since, timeout, sysfs):
+    for port in ports:
+        try:
+            result = hub.wait_for_enumeration(port, timeout=timeout, sysfs=sysfs, since=since)
+        except TimeoutError as e:
+            print(e)
+            continue
+
+        if result.sysfs is None:
+            print("Port {} : {} speed link in {:.0f} ms".format(port, result.speed, result.link*1000))
+        else:
+            print("Port {} : {} speed link in {:.0f} ms, {} in {:.0f} ms".format(port, result.speed, result.link*1000, result.path, result.sysfs*1000))
+
 def _print_row(data):
     print(*[str(v).rjust(COL_WIDTH) for v in data])
 
@@ -121,7 +138,10 @@ def data():
 @click.option('--port', default=None, help='Comma separated list of ports (1 thru 4) to act upon.')
 @click.option('--on', default=False, is_flag=True, help='Enable data to the listed ports.')
 @click.option('--off', default=False, is_flag=True, help='Disable data to the listed ports.')
-def state(port, on, off):
+@click.option('--wait', default=False, is_flag=True, help='After enabling, wait for devices on the listed ports to enumerate.')
+@click.option('--sysfs', default=False, is_flag=True, help='With \'--wait\', also wait for the Linux device node to appear.')
+@click.option('--timeout', default=5.0, help='Seconds to wait for enumeration.')
+def state(port, on, off, wait, sysfs, timeout):
     """ Get or set per-port data state.  With no arguments, will print out if port data is on or off. """
 
     if on and off:
@@ -136,7 +156,11 @@ def state(port, on, off):
             port = [int(p) for p in port.split(",")]
 
     if on:
+        since = time.monotonic()
         hub.data_enable(ports=port)
+
+        if wait:
+            _wait_for_ports(port, since, timeout, sysfs)
     elif off:
         hub.data_disable(ports=port)
     else:
@@ -152,27 +176,94 @@ def power():
 @power.command()
 @click.option('--loop', default=False, is_flag=True, help='Continue to output data until CTRL-C.')
 @click.option('--delay', default=500, help='Delay in ms between current samples.')
-def measure(loop, delay):
+@click.option('--oversample', default=0, help='Average this many readings per single-shot measurement, reporting the uncertainty.')
+@click.option('--filter', 'name', default='mean', type=click.Choice(['mean', 'median', 'ema']), help='Filter applied to oversampled readings.')
+def measure(loop, delay, oversample, name):
     """ Reports single-shot or continuous power measurements. """
 
     if loop:
-        delay_ms = float(delay)/1000
-        start = time.time()
+        start = time.monotonic()
 
-        while True:
-            try:
-                ellapsed = time.time() - start
-                data = hub.power.measurements()
+        def report(sample):
+            print("%.3f" % (sample.timestamp - start), " ".join([("%.2f" % v).rjust(7) for v in sample.values]))
 
-                print("%.3f" % ellapsed, " ".join([("%.2f" % v).rjust(7) for v in data]))
-            except usb.core.USBError:
-                pass
+        ## The sampler keeps a fixed rate (USB errors are skipped), 
+        ## so output does not drift by the time each measurement takes.
+        sampler = hub.power.sampler(rate=1000.0/float(delay), size=1)
+        sampler.add_callback(report)
+        sampler.start()
 
-            time.sleep(delay_ms)
+        while True:
+            time.sleep(1)
+    elif oversample > 1:
+        data = hub.power.oversample(samples=oversample, filter=name)
+
+        _print_row(PORTS)
+        _print_row(["%.1f mA" % m.value for m in data])
+        _print_row(["± %.1f mA" % m.uncertainty for m in data])
     else:
         _print_row(PORTS)
         _print_row(["%.2f mA" % v for v in hub.power.measurements()])
 
+@power.command()
+@click.option('--delay', default=100, help='Delay in ms between current samples.')
+@click.option('--voltage', default=5.0, help='Nominal port voltage used to compute energy.')
+def energy(delay, voltage):
+    """ Integrates per-port charge & energy, printing running totals until CTRL-C. """
+
+    sampler = hub.power.sampler(rate=1000.0/float(delay), size=1)
+    meter = hub.power.energy_meter(sampler, voltage=voltage)
+    sampler.start()
+
+    _print_row(PORTS)
+
+    try:
+        while True:
+            time.sleep(1)
+            totals = meter.counters()
+            _print_row(["%.3f mAh" % v for v in totals.charge])
+    except KeyboardInterrupt:
+        sampler.stop()
+
+        totals = meter.counters()
+        print()
+        _print_row(["%.3f mWh" % v for v in totals.energy])
+        print("{:.1f} s integrated, {:.1f} s of gaps".format(totals.duration, totals.gap))
+
+@power.command()
+@click.argument('path')
+@click.option('--delay', default=500, help='Delay in ms between samples.')
+@click.option('--state', default=False, is_flag=True, help='Also record power, data, and connection state of each port.')
+def record(path, delay, state):
+    """ Append power measurements to a binary telemetry file until CTRL-C. """
+
+    device = hub.device
+    period = float(delay)/1000
+    deadline = time.monotonic()
+
+    with TelemetryRecorder(path) as recorder:
+        while True:
+            try:
+                recorder.record_device(device, state=state)
+            except usb.core.USBError:
+                pass
+
+            deadline += period
+            time.sleep(max(0, deadline - time.monotonic()))
+
+@power.command()
+@click.argument('path')
+@click.argument('output')
+@click.option('--start', default=None, type=float, help='Only export records at or after this UNIX timestamp.')
+@click.option('--end', default=None, type=float, help='Only export records before this UNIX timestamp.')
+def export(path, output, start, end):
+    """ Convert a binary telemetry file to CSV. """
+
+    with TelemetryReader(path) as reader:
+        count = reader.to_csv(output, start=start, end=end)
+
+    print("Exported {} records to {}".format(count, output))
+
 @power.command()
 @click.option('--port', default=None, help='Comma separated list of ports (1 thru 4) to act upon.')
 @click.option('--ma', default=2670, help='Current limit in mA for specified ports.')
@@ -206,7 +297,11 @@ def alerts():
 @click.option('--off', default=False, is_flag=True, help='Disable power to the listed ports.')
 @click.option('--reset', default=False, is_flag=True, help='Reset power to the listed ports (cycles power off & on).')
 @click.option('--delay', default=500, help='Delay in ms between off and on states during reset action.')
-def state(port, on, off, reset, delay):
+@click.option('--stagger', default=0, help='Delay in ms between re-enabling each port during reset action.')
+@click.option('--wait', default=False, is_flag=True, help='After enabling, wait for devices on the listed ports to enumerate.')
+@click.option('--sysfs', default=False, is_flag=True, help='With \'--wait\', also wait for the Linux device node to appear.')
+@click.option('--timeout', default=5.0, help='Seconds to wait for enumeration.')
+def state(port, on, off, reset, delay, stagger, wait, sysfs, timeout):
     """ Get or set per-port power state.  With no arguments, will print out if port power is on or off. """
 
     if on and off:
@@ -221,17 +316,31 @@ def state(port, on, off, reset, delay):
             port = [int(p) for p in port.split(",")]
 
     if on:
+        since = time.monotonic()
         hub.power.enable(ports=port)
     elif off:
         hub.power.disable(ports=port)
+    elif reset and stagger > 0:
+        scheduler = PortScheduler(hub.device)
+        scheduler.power_cycle(ports=port, off_time=float(delay)/1000, step=float(stagger)/1000)
+
+        results = scheduler.run()
+        since = scheduler.started + min(result.executed for result in results if result.action == 'power_on')
+        report = jitter_report(results)
+
+        print("Reset {} port(s), max jitter {:.1f} ms".format(len(port), report['max']*1000))
     elif reset:
         hub.power.disable(ports=port)
         time.sleep(float(delay)/1000)
+        since = time.monotonic()
         hub.power.enable(ports=port)
     else:
         _print_row(PORTS)
         _print_row(["on" if s else "off" for s in hub.power.state()])
 
+    if wait and (on or reset):
+        _wait_for_ports(port, since, timeout, sysfs)
+
 
 def main():
     cli()
@@ -23,12 +23,15 @@
 import struct
 import logging
 import weakref
+from collections import namedtuple
 
 from .i2c import USBHubI2C
 from .spi import USBHubSPI
 from .gpio import USBHubGPIO
-from .power import USBHubPower
+from .power import USBHubPower, _decode_measure, _decode_limits
 from .config import USBHubConfig
+from .watchdog import PowerWatchdog
+from .ports import PortMonitor, decode_link, wait_for_enumeration, REG_CONNECTION, REG_CONNECTION_LENGTH
 from .util import *
 
 EEPROM_I2C_ADDR = 0x50
@@ -40,6 +43,10 @@ EEPROM_SKU_BYTES = 0x06
 MCP_I2C_ADDR = 0x20
 MCP_REG_GPIO = 0x09
 
+## Snapshot of a single downstream port.  'stale' is the set of field names which 
+## could not be refreshed and hold the value from the previous snapshot.
+PortStatus = namedtuple('PortStatus', ['port', 'connected', 'speed', 'data', 'power', 'current', 'limit', 'stale'])
+
 class USBHubDevice:
 
     CMD_REG_WRITE = 0x03
@@ -52,7 +59,11 @@ class USBHubDevice:
         timeout           = 100,
         i2c_attempts_max  = 5,
         i2c_attempt_delay = 10,
-        disable_i2c       = False
+        disable_i2c       = False,
+        spi_combine_writes  = False,
+        spi_combine_latency = 5,
+        config_timeout      = None,
+        config_cache        = False
     ):
 
         self.main = main
@@ -86,14 +97,35 @@ class USBHubDevice:
         else:
             enable_i2c()
 
-        self.spi = USBHubSPI(proxy, timeout=timeout)
+        self.spi = USBHubSPI(proxy,
+            timeout         = timeout,
+            combine_writes  = spi_combine_writes,
+            combine_latency = spi_combine_latency
+        )
         self.gpio = USBHubGPIO(proxy)
         self.power = USBHubPower(proxy)
-        self.config = USBHubConfig(proxy)
+        self.config = USBHubConfig(proxy, timeout=config_timeout, cache=config_cache)
+
+        self._port_status_last = {}
 
         logging.debug("Device class created")
         logging.debug("Firmware version {} running on {}".format(self.config.version, self.config.circuitpython_version))
 
+    def register_read_raw(self, addr, length, base=REG_BASE_DFT):
+        ## Need to offset the register address for USB access
+        address = addr + base
+
+        ## Split 32 bit register address into the 16 bit value & index fields
+        value = address & 0xFFFF
+        index = address >> 16
+
+        data = list(self.handle.ctrl_transfer(REQ_IN, self.CMD_REG_READ, value, index, length))
+
+        if length != len(data):
+            raise ValueError('Incorrect data length')
+
+        return data
+
     def register_read(self, name=None, addr=None, length=1, print=False, endian='big', base=REG_BASE_DFT):
         if name != None:
             addr, bits, endian = self.main.find_register_by_name(name)
@@ -109,17 +141,25 @@ class USBHubDevice:
         if addr == None:
             raise ValueError('Must specify an name or address')
 
-        ## Need to offset the register address for USB access
-        address = addr + base
+        data = self.register_read_raw(addr, length, base)
+        parsed = self.decode_register(name, addr, data, endian)
 
-        ## Split 32 bit register address into the 16 bit value & index fields
-        value = address & 0xFFFF
-        index = address >> 16
+        if parsed is None:
+            print = False
 
-        data = list(self.handle.ctrl_transfer(REQ_IN, self.CMD_REG_READ, value, index, length))
+        if print:
+            self.main.print_register(parsed)
 
-        if length != len(data):
-            raise ValueError('Incorrect data length')
+        logging.debug("{} [0x{}] read {} [{}]".format(name, hexstr(addr), length, " ".join(["0x"+hexstr(v) for v in data])))
+        
+        return data, parsed
+
+    def decode_register(self, name, addr, data, endian='big'):
+        ## Reads spanning several registers, or of unknown registers, are not parsed
+        bits = len(data) * 8
+
+        if name is None or bits not in [8, 16, 24, 32]:
+            return None
 
         shift = 0
 
@@ -137,20 +177,10 @@ class USBHubDevice:
         elif bits == 32:
             code = 'L'
 
-        if name is None:
-            parsed = None
-        else:
-            num    = bits_to_bytes(bits)
-            value  = int_from_bytes(data, endian)
-            stream = struct.pack(">HB" + code, *[addr, num, value << shift])
-            parsed = self.main.parse_register(name, stream)
-
-        if print:
-            self.main.print_register(parsed)
-
-        logging.debug("{} [0x{}] read {} [{}]".format(name, hexstr(addr), length, " ".join(["0x"+hexstr(v) for v in data])))
-        
-        return data, parsed
+        num    = bits_to_bytes(bits)
+        value  = int_from_bytes(data, endian)
+        stream = struct.pack(">HB" + code, *[addr, num, value << shift])
+        return self.main.parse_register(name, stream)
 
     def register_write(self, name=None, addr=None, buf=[]):
         if name != None:
@@ -186,6 +216,82 @@ class USBHubDevice:
         return [speeds[speed.body[key]] for key in register_keys(speed)]
 
 
+    def _port_link(self):
+        ## decode_link applies the logical to physical port remapping used by 'connections' & 'speeds'
+        data = self.register_read_raw(REG_CONNECTION, REG_CONNECTION_LENGTH)
+        return decode_link(data)
+
+    def _port_mcu(self):
+        if self.config.version > 1:
+            values = self.config.get_many(["data_state", "power_measure_12", "power_measure_34", "power_limits"])
+            data = values["data_state"]
+            current = _decode_measure(values["power_measure_12"]) + _decode_measure(values["power_measure_34"])
+            limit = _decode_limits(values["power_limits"])
+        else:
+            data = self._data_state()
+            current = self.power.measurements()
+            limit = self.power.limits()
+
+        data = [not get_bit(data, idx) for idx in [7,6,5,4]]
+
+        return data, current, limit
+
+    def port_monitor(self, rate=20):
+        """Create a PortMonitor for this Hub.  Call 'start' on it to begin polling."""
+        return PortMonitor([self], rate=rate)
+
+    def watchdog(self, policy=None, rate=20):
+        """Create a PowerWatchdog for this Hub.  Call 'start' on it to begin monitoring."""
+        return PowerWatchdog(self, policy=policy, rate=rate)
+
+    def wait_for_enumeration(self, port, timeout=5.0, speed=None, sysfs=False, since=None):
+        """Block until a device on the port has enumerated.  See ports.wait_for_enumeration."""
+        return wait_for_enumeration(self, port, timeout=timeout, speed=speed, sysfs=sysfs, since=since)
+
+    def port_status(self):
+        """Return a PortStatus for each downstream port using as few transfers as possible.
+
+        One register read covers connection & speed, one covers the power control 
+        registers, and the firmware parameters come from a single mailbox session.
+        If a group cannot be read, values from the previous snapshot are used
+        and listed in the 'stale' field.
+        """
+        groups = [
+            ('link',  ['connected', 'speed'],         self._port_link),
+            ('power', ['power'],                      lambda: (self.power.state(),)),
+            ('mcu',   ['data', 'current', 'limit'],   self._port_mcu),
+        ]
+
+        fields = {}
+        stale = set()
+
+        for group, names, function in groups:
+            try:
+                values = function()
+                self._port_status_last[group] = values
+            except (usb.core.USBError, OSError) as error:
+                if group not in self._port_status_last:
+                    raise
+
+                logging.warn("Port status using previous {} values : {}".format(group, error))
+                values = self._port_status_last[group]
+                stale.update(names)
+
+            fields.update(zip(names, values))
+
+        stale = frozenset(stale)
+
+        return [PortStatus(
+            port      = idx + 1,
+            connected = fields['connected'][idx],
+            speed     = fields['speed'][idx],
+            data      = fields['data'][idx],
+            power     = fields['power'][idx],
+            current   = fields['current'][idx],
+            limit     = fields['limit'][idx],
+            stale     = stale
+        ) for idx in range(4)]
+
     def load_descriptor(self):
         ## If descriptor has already been loaded, return early
         if self._descriptor is not None:
@@ -338,6 +444,12 @@ class USBHubDevice:
 
         return self.i2c.read_i2c_block_data(MCP_I2C_ADDR, MCP_REG_GPIO, 1)[0]
 
+    def _data_write(self, value):
+        if self.config.version > 1:
+            self.config.set("data_state", int(value))
+        else:
+            self.i2c.write_bytes(MCP_I2C_ADDR, bytes([MCP_REG_GPIO, int(value)]))
+
     def data_state(self):
         value = self._data_state()
         return ["off" if get_bit(value, idx) else "on" for idx in [7,6,5,4]]
@@ -348,10 +460,7 @@ class USBHubDevice:
         for port in ports:
             value = clear_bit(value, 8-port)
 
-        if self.config.version > 1:
-            self.config.set("data_state", int(value))
-        else:
-            self.i2c.write_bytes(MCP_I2C_ADDR, bytes([MCP_REG_GPIO, int(value)]))
+        self._data_write(value)
 
     def data_disable(self, ports=[]):
         value = self._data_state()
@@ -359,10 +468,64 @@ class USBHubDevice:
         for port in ports:
             value = set_bit(value, 8-port)
 
-        if self.config.version > 1:
-            self.config.set("data_state", int(value))
-        else:
-            self.i2c.write_bytes(MCP_I2C_ADDR, bytes([MCP_REG_GPIO, int(value)]))
+        self._data_write(value)
+
+    def apply_port_state(self, states):
+        """Bring ports to a desired state, writing only what differs from the present state.
+
+        'states' maps port number to a dict with optional 'power' and 'data' 
+        booleans, e.g. {1: {"power": True, "data": False}}.  Present power and 
+        data state are each read once.  Each power change is one control 
+        register write, and all data changes are a single write of the data 
+        mask.  Returns the changes made as {port: {field: (old, new)}}.
+        """
+        for port, state in states.items():
+            if port not in [1,2,3,4]:
+                raise ValueError("Port must be between 1 and 4")
+
+            for field in state.keys():
+                if field not in ["power", "data"]:
+                    raise ValueError("Unknown port state '{}', must be 'power' or 'data'".format(field))
+
+        changes = {}
+
+        def changed(port, field, old, new):
+            changes.setdefault(port, {})[field] = (old, new)
+
+        power = [port for port, state in states.items() if state.get("power") is not None]
+        data = [port for port, state in states.items() if state.get("data") is not None]
+
+        if len(power) > 0:
+            present = self.power.state()
+            enable = []
+            disable = []
+
+            for port in sorted(power):
+                wanted = bool(states[port]["power"])
+
+                if present[port-1] != wanted:
+                    (enable if wanted else disable).append(port)
+                    changed(port, "power", present[port-1], wanted)
+
+            self.power.disable(ports=disable)
+            self.power.enable(ports=enable)
+
+        if len(data) > 0:
+            present = self._data_state()
+            value = present
+
+            ## A set bit in the data mask turns the port's data off
+            for port in sorted(data):
+                wanted = bool(states[port]["data"])
+                value = set_bit_to(value, 8-port, not wanted)
+
+                if get_bit(present, 8-port) == wanted:
+                    changed(port, "data", not wanted, wanted)
+
+            if value != present:
+                self._data_write(value)
+
+        return changes
 
     def _utf16le_to_string(data):
         out = ""
@@ -0,0 +1,161 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import threading
+import time
+from collections import namedtuple
+
+## 'charge' is per-port mAh, 'energy' per-port mWh.  'duration' is the number of seconds 
+## integrated, which excludes 'gap' seconds where samples were too far apart to integrate.
+EnergyTotals = namedtuple('EnergyTotals', ['label', 'start', 'duration', 'gap', 'charge', 'energy'])
+
+_PORTS = 4
+
+## mA * s to mAh
+_TO_MAH = 1.0 / 3600.0
+
+class _Accumulator:
+    def __init__(self, label=None, start=None):
+        self.label = label
+        self.start = start
+        self.duration = 0.0
+        self.gap = 0.0
+        self.charge = [0.0] * _PORTS
+
+    def totals(self, voltage):
+        charge = [value * _TO_MAH for value in self.charge]
+        energy = [value * volts for value, volts in zip(charge, voltage)]
+        return EnergyTotals(self.label, self.start, self.duration, self.gap, charge, energy)
+
+class EnergyMeter:
+    """Integrates per-port current samples into charge (mAh) and energy (mWh).
+
+    Samples are integrated with the trapezoidal rule over their monotonic 
+    timestamps.  Intervals longer than 'max_gap' seconds (by default three 
+    sample periods) are not integrated, but are counted in 'gap'.  The Hub does 
+    not measure port voltage, so energy uses the nominal 'voltage' (one value, 
+    or one per port).
+
+    Memory use is constant: only running sums and the previous sample are kept.
+    Resettable counters and the current session are tracked separately, so 
+    counters can be zeroed without losing the session total.
+
+        meter = hub.power.energy_meter()
+        meter.sampler.start()
+        ...
+        print(meter.counters().charge)
+    """
+
+    def __init__(self, sampler=None, voltage=5.0, max_gap=None):
+        if not isinstance(voltage, (list, tuple)):
+            voltage = [voltage] * _PORTS
+
+        self.voltage = [float(value) for value in voltage]
+        self.sampler = None
+        self.max_gap = max_gap
+        self.samples = 0
+
+        self._lock = threading.Lock()
+        self._last = None
+
+        self._counters = _Accumulator(start=time.monotonic())
+        self._session = _Accumulator(start=time.monotonic())
+
+        if sampler is not None:
+            self.attach(sampler)
+
+    def attach(self, sampler):
+        """Integrate every sample taken by a PowerSampler."""
+        self.detach()
+        self.sampler = sampler
+
+        if self.max_gap is None:
+            self.max_gap = 3 * sampler.period
+
+        sampler.add_callback(self._on_sample)
+
+    def detach(self):
+        if self.sampler is not None:
+            self.sampler.remove_callback(self._on_sample)
+            self.sampler = None
+
+    def _on_sample(self, sample):
+        self.update(sample.timestamp, sample.values)
+
+    def update(self, timestamp, values):
+        """Integrate one sample of the currents (mA) of ports 1 thru 4, taken at a time.monotonic() timestamp."""
+        values = [float(value) for value in values[0:_PORTS]]
+
+        with self._lock:
+            last = self._last
+
+            ## Out of order or repeated samples carry no new information
+            if last is not None and timestamp <= last[0]:
+                return
+
+            self._last = (timestamp, values)
+            self.samples += 1
+
+            if last is None:
+                return
+
+            delta = timestamp - last[0]
+
+            if self.max_gap is not None and delta > self.max_gap:
+                for acc in [self._counters, self._session]:
+                    acc.gap += delta
+                return
+
+            for acc in [self._counters, self._session]:
+                acc.duration += delta
+
+                for idx in range(_PORTS):
+                    acc.charge[idx] += (last[1][idx] + values[idx]) * 0.5 * delta
+
+    def counters(self):
+        """Return EnergyTotals accumulated since the counters were last reset."""
+        with self._lock:
+            return self._counters.totals(self.voltage)
+
+    def reset(self, ports=[1,2,3,4]):
+        """Zero the resettable counters of the given ports.  The session total is unaffected."""
+        with self._lock:
+            for port in ports:
+                self._counters.charge[port-1] = 0.0
+
+            if len(ports) == _PORTS:
+                self._counters.start = time.monotonic()
+                self._counters.duration = 0.0
+                self._counters.gap = 0.0
+
+    def session(self):
+        """Return EnergyTotals of the current session."""
+        with self._lock:
+            return self._session.totals(self.voltage)
+
+    def start_session(self, label=None):
+        """Begin a new session (for instance for the next device under test) and return the totals of the previous one."""
+        with self._lock:
+            totals = self._session.totals(self.voltage)
+            self._session = _Accumulator(label=label, start=time.monotonic())
+
+        return totals
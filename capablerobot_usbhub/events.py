@@ -0,0 +1,163 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+
+class PollingEventSource:
+    """Base for services which poll the Hub from a background thread and emit events.
+
+    Subclasses implement 'poll', which samples the hardware once and calls 
+    '_emit' for each event found.  Events are delivered to registered callbacks 
+    (on the polling thread), queued for the 'events' iterator, and passed to
+    any 'async for' consumers on their event loops.  When nobody
+    consumes the queue, the oldest events are dropped.
+    """
+
+    name = "usbhub-events"
+
+    def __init__(self, period, queue_size=1024):
+        self.period = period
+
+        self._callbacks = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._async_queues = []
+
+        self._thread = None
+        self._running = threading.Event()
+
+        ## Poll slots skipped because a poll overran its interval
+        self.missed = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def add_callback(self, callback, **match):
+        """Call 'callback(event)' for events whose fields equal the given values (None matches anything)."""
+        match = {key:value for key, value in match.items() if value is not None}
+        self._callbacks.append((callback, match))
+
+    def remove_callback(self, callback):
+        self._callbacks = [entry for entry in self._callbacks if entry[0] != callback]
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._running.clear()
+        self._thread.join()
+        self._thread = None
+
+    def events(self, timeout=None):
+        """Yield events as they arrive.  Stops after 'timeout' seconds without an event."""
+        while True:
+            try:
+                yield self._queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    async def aevents(self):
+        """Asynchronously yield events as they arrive, for use with 'async for'."""
+        loop = asyncio.get_event_loop()
+        entry = (loop, asyncio.Queue())
+        self._async_queues.append(entry)
+
+        try:
+            while True:
+                yield await entry[1].get()
+        finally:
+            self._async_queues.remove(entry)
+
+    def __aiter__(self):
+        return self.aevents()
+
+    def _emit(self, event):
+        for callback, match in self._callbacks:
+            if any(getattr(event, key) != value for key, value in match.items()):
+                continue
+
+            try:
+                callback(event)
+            except Exception:
+                logging.exception("{} callback failed".format(self.name))
+
+        if self._queue.full():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+        self._queue.put_nowait(event)
+
+        for loop, pending in list(self._async_queues):
+            loop.call_soon_threadsafe(pending.put_nowait, event)
+
+    def poll(self):
+        raise NotImplementedError
+
+    def _interval(self, events):
+        ## Seconds until the next poll, given the events found by the last one
+        return self.period
+
+    def _run(self):
+        deadline = time.monotonic()
+
+        while self._running.is_set():
+            found = self.poll()
+
+            ## Schedule against absolute deadlines so the poll rate does not
+            ## drift with the time taken by the USB transfers themselves.  If a 
+            ## poll overran its slot, skip the slots that were missed.
+            interval = self._interval(found)
+            deadline += interval
+            now = time.monotonic()
+
+            if now > deadline:
+                if interval > 0:
+                    skipped = int((now - deadline) / interval) + 1
+                    self.missed += skipped
+                    deadline += skipped * interval
+                else:
+                    deadline = now
+
+            delay = deadline - now
+
+            ## Sleep in short steps so 'stop' is not held up by a long interval
+            while delay > 0 and self._running.is_set():
+                time.sleep(min(delay, 0.1))
+                delay = deadline - time.monotonic()
@@ -0,0 +1,145 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import math
+from collections import namedtuple
+
+## A filtered reading.  'uncertainty' is an estimate of the standard error of 'value' 
+## (same units), and 'samples' the number of raw readings which contributed to it.
+Measurement = namedtuple('Measurement', ['value', 'uncertainty', 'samples'])
+
+class _Filter:
+    """Base class of streaming per-port filters.
+
+    'resolution' is the step size of the raw readings.  When readings show no 
+    spread at all, averaging cannot resolve below a step, so the uncertainty
+    is that of the quantization alone (resolution / sqrt(12)).
+    """
+
+    def __init__(self, ports=4, resolution=None):
+        self.ports = ports
+        self.resolution = resolution
+        self.reset()
+
+    def _floor(self, uncertainty):
+        ## Identical readings can still leave floating point residue in the variance
+        if uncertainty < 1e-9 and self.resolution is not None:
+            return self.resolution / math.sqrt(12)
+
+        return uncertainty
+
+    def update(self, values):
+        """Add one reading per port and return a Measurement per port."""
+        return [self._update(idx, float(value)) for idx, value in enumerate(values)]
+
+def _variance(values, mean):
+    if len(values) < 2:
+        return 0.0
+
+    return sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+
+class MovingAverage(_Filter):
+    """Mean of the last 'window' readings of each port."""
+
+    def __init__(self, window=16, ports=4, resolution=None):
+        self.window = window
+        super().__init__(ports, resolution)
+
+    def reset(self):
+        self._values = [collections.deque(maxlen=self.window) for _ in range(self.ports)]
+
+    def _update(self, idx, value):
+        values = self._values[idx]
+        values.append(value)
+
+        mean = sum(values) / len(values)
+        uncertainty = math.sqrt(_variance(values, mean) / len(values))
+
+        return Measurement(mean, self._floor(uncertainty), len(values))
+
+class MedianFilter(_Filter):
+    """Median of the last 'window' readings of each port.
+
+    Rejects occasional outliers, but unlike the averaging filters the result 
+    stays on the step size of the raw readings.
+    """
+
+    def __init__(self, window=5, ports=4, resolution=None):
+        self.window = window
+        super().__init__(ports, resolution)
+
+    def reset(self):
+        self._values = [collections.deque(maxlen=self.window) for _ in range(self.ports)]
+
+    def _update(self, idx, value):
+        values = self._values[idx]
+        values.append(value)
+
+        ordered = sorted(values)
+        middle = len(ordered) // 2
+
+        if len(ordered) % 2 == 1:
+            median = ordered[middle]
+        else:
+            median = (ordered[middle-1] + ordered[middle]) / 2
+
+        ## For normally distributed noise the median is ~1.25x noisier than the mean
+        mean = sum(values) / len(values)
+        uncertainty = 1.2533 * math.sqrt(_variance(values, mean) / len(values))
+
+        return Measurement(median, self._floor(uncertainty), len(values))
+
+class ExponentialAverage(_Filter):
+    """Exponentially weighted moving average of each port, with smoothing factor 'alpha' (0 to 1).
+
+    Needs no history, and tracks an exponentially weighted variance alongside 
+    the mean to estimate the uncertainty.
+    """
+
+    def __init__(self, alpha=0.2, ports=4, resolution=None):
+        if not 0 < alpha <= 1:
+            raise ValueError("Alpha must be greater than 0 and at most 1")
+
+        self.alpha = alpha
+        super().__init__(ports, resolution)
+
+    def reset(self):
+        self._mean = [None] * self.ports
+        self._var = [0.0] * self.ports
+        self._count = [0] * self.ports
+
+    def _update(self, idx, value):
+        self._count[idx] += 1
+
+        if self._mean[idx] is None:
+            self._mean[idx] = value
+        else:
+            diff = value - self._mean[idx]
+            incr = self.alpha * diff
+            self._mean[idx] += incr
+            self._var[idx] = (1 - self.alpha) * (self._var[idx] + diff * incr)
+
+        ## Variance of an EMA of independent samples is var * alpha / (2 - alpha)
+        uncertainty = math.sqrt(self._var[idx] * self.alpha / (2 - self.alpha))
+
+        return Measurement(self._mean[idx], self._floor(uncertainty), self._count[idx])
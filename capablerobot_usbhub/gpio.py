@@ -21,11 +21,14 @@
 # THE SOFTWARE.
 
 import logging
+import time
+from collections import namedtuple
 
 import usb.core
 import usb.util
 
 from .util import *
+from .events import PollingEventSource
 
 _OUTPUT_ENABLE  = 0x0900
 _INPUT_ENABLE   = 0x0910
@@ -43,6 +46,31 @@ _GPIO0_BIT = [0, 6]
 _GPIO1_BIT = [1, 3]
 _GPIOS = [_GPIO0_BIT, _GPIO1_BIT]
 
+## Registers which are only changed by this driver, so a host-side copy
+## can stand in for a read before each read-modify-write cycle
+_SHADOWED = [_OUTPUT_ENABLE, _INPUT_ENABLE, _OUTPUT, _PULL_UP, _PULL_DOWN, _OPEN_DRAIN, _DEBOUNCE, _DEBOUNCE_TIME]
+
+## GPIO registers sit 0x10 apart in two banks, with an undocumented range
+## (0x0970 to 0x09DF) between them.  A span read never crosses from one bank to the other.
+_BANKS = [(_OUTPUT_ENABLE, _OPEN_DRAIN), (_DEBOUNCE, _DEBOUNCE_TIME)]
+
+## Pin settings and the register holding each one.  Changed registers
+## are written in this order, which is the order 'configure' has always used.
+_SETTINGS = dict(
+    output     = _OUTPUT_ENABLE,
+    input      = _INPUT_ENABLE,
+    pull_down  = _PULL_DOWN,
+    pull_up    = _PULL_UP,
+    open_drain = _OPEN_DRAIN,
+    debounce   = _DEBOUNCE,
+)
+
+## Hardware debounce counts in units of 10 ms, held in the low byte of the register
+_DEBOUNCE_UNIT = 10
+_DEBOUNCE_MAX  = 0xFF
+
+GPIOEdge = namedtuple('GPIOEdge', ['timestamp', 'key', 'io', 'edge'])
+
 class USBHubGPIO:
 
     def __init__(self, hub):
@@ -54,64 +82,178 @@ class USBHubGPIO:
         self._io1_output_config = None
         self._io1_input_config  = None
 
+        self._shadow = {}
+
     def _read(self, addr):
         data, _ = self.hub.register_read(addr=addr, length=4)
         return data
 
-    def configure(self, ios=[], output=None, input=None, pull_down=None, pull_up=None, open_drain=None):
-        
-        if output is not None:
-            self.configure_output(ios=ios, value=output)
+    def _shadow_read(self, addr):
+        if addr not in self._shadow:
+            self._shadow[addr] = self._read(addr=addr)
+
+        return self._shadow[addr].copy()
 
-        if input is not None:
-            self.configure_input(ios=ios, value=input)
+    def _shadow_write(self, addr, desired):
+        if self._shadow.get(addr) == desired:
+            return
 
-        if pull_down is not None:
-            self.configure_pull_down(ios=ios, value=pull_down)
+        try:
+            self.hub.register_write(addr=addr, buf=desired)
+        except OSError:
+            ## State of the register is unknown, so reload it on next use
+            self._shadow.pop(addr, None)
+            raise
 
-        if pull_up is not None:
-            self.configure_pull_up(ios=ios, value=pull_up)
+        self._shadow[addr] = list(desired)
 
-        if open_drain is not None:
-            self.configure_open_drain(ios=ios, value=open_drain)
+    def resync(self):
+        """Discard the cached register copies and reload them from the Hub."""
+        self._shadow = {}
 
-    def _generic_configure(self, addr, ios, value):
-        current = self._read(addr=addr)
-        desired = current.copy()
+        for addr in _SHADOWED:
+            self._shadow_read(addr)
 
-        if 0 in ios:
-            if addr == _OUTPUT_ENABLE:
-                self._io0_output_config = value
-            if addr == _INPUT_ENABLE:
-                self._io0_input_config = value
+    def verify(self):
+        """Compare cached register copies against the Hub, returning the addresses that differ.
 
-            desired[_GPIO0_BIT[0]] = set_bit_to(desired[_GPIO0_BIT[0]], _GPIO0_BIT[1], value)            
+        Registers which differ are reloaded so later writes start from the Hub's state.
+        """
+        stale = []
 
-        if 1 in ios:
-            if addr == _OUTPUT_ENABLE:
-                self._io1_output_config = value
-            if addr == _INPUT_ENABLE:
-                self._io1_input_config = value
+        for addr, value in list(self._shadow.items()):
+            current = self._read(addr=addr)
 
-            desired[_GPIO1_BIT[0]] = set_bit_to(desired[_GPIO1_BIT[0]], _GPIO1_BIT[1], value)
+            if current != value:
+                logging.warn("GPIO register 0x{} changed outside of driver".format(hexstr(addr)))
+                self._shadow[addr] = current
+                stale.append(addr)
 
-        if current != desired:
-            self.hub.register_write(addr=addr, buf=desired)
+        return stale
+
+    def _load_shadow(self, addrs):
+        missing = [addr for addr in addrs if addr not in self._shadow]
+
+        for first, last in _BANKS:
+            group = [addr for addr in missing if first <= addr <= last]
+
+            if len(group) == 0:
+                continue
+
+            if len(group) == 1:
+                self._shadow_read(group[0])
+                continue
+
+            ## Fetch every missing register in this bank with a single read
+            ## spanning from the lowest to the highest
+            start = min(group)
+            end = max(group) + 4
+
+            data, _ = self.hub.register_read(addr=start, length=end-start)
+
+            for addr in _SHADOWED:
+                if start <= addr < end and addr not in self._shadow:
+                    self._shadow[addr] = list(data[addr-start:addr-start+4])
+
+    def configure_pins(self, pins):
+        """Apply settings to many pins at once, writing only the registers which change.
+
+        'pins' maps IO number to a dict of settings, for example:
+        {0 : dict(output=True), 1 : dict(input=True, pull_up=True)}
+        """
+        for io, settings in pins.items():
+            if io not in range(len(_GPIOS)):
+                raise ValueError("GPIO must be between 0 and {}".format(len(_GPIOS) - 1))
+
+            for key in settings.keys():
+                if key not in _SETTINGS:
+                    raise ValueError("Unknown GPIO setting '{}'".format(key))
+
+        addrs = [addr for key, addr in _SETTINGS.items() if any(key in settings for settings in pins.values())]
+        self._load_shadow(addrs)
+
+        for key, addr in _SETTINGS.items():
+            if addr not in addrs:
+                continue
+
+            desired = self._shadow[addr].copy()
+
+            for io, settings in pins.items():
+                if key not in settings:
+                    continue
+
+                value = settings[key]
+                byte, bit = _GPIOS[io]
+                desired[byte] = set_bit_to(desired[byte], bit, value)
+
+                if key == 'output':
+                    setattr(self, "_io{}_output_config".format(io), value)
+                if key == 'input':
+                    setattr(self, "_io{}_input_config".format(io), value)
+
+            self._shadow_write(addr, desired)
+
+    def configure(self, ios=[], output=None, input=None, pull_down=None, pull_up=None, open_drain=None, debounce=None):
+        settings = dict(output=output, input=input, pull_down=pull_down, pull_up=pull_up, open_drain=open_drain, debounce=debounce)
+        settings = {key:value for key, value in settings.items() if value is not None}
+
+        self.configure_pins({io:settings for io in ios})
 
     def configure_output(self, ios, value):
-        self._generic_configure(_OUTPUT_ENABLE, ios, value)
+        self.configure_pins({io:dict(output=value) for io in ios})
 
     def configure_input(self, ios, value):
-        self._generic_configure(_INPUT_ENABLE, ios, value)
+        self.configure_pins({io:dict(input=value) for io in ios})
 
     def configure_pull_up(self, ios, value):
-        self._generic_configure(_PULL_UP, ios, value)
+        self.configure_pins({io:dict(pull_up=value) for io in ios})
 
     def configure_pull_down(self, ios, value):
-        self._generic_configure(_PULL_DOWN, ios, value)
+        self.configure_pins({io:dict(pull_down=value) for io in ios})
 
     def configure_open_drain(self, ios, value):
-        self._generic_configure(_OPEN_DRAIN, ios, value)
+        self.configure_pins({io:dict(open_drain=value) for io in ios})
+
+    def configure_debounce(self, ios, value):
+        self.configure_pins({io:dict(debounce=value) for io in ios})
+
+    @property
+    def debounce_time(self):
+        """Hardware debounce period in ms, shared by all pins with debounce enabled."""
+        return self._shadow_read(addr=_DEBOUNCE_TIME)[0] * _DEBOUNCE_UNIT
+
+    @debounce_time.setter
+    def debounce_time(self, value):
+        count = int(round(float(value) / _DEBOUNCE_UNIT))
+
+        if count < 0 or count > _DEBOUNCE_MAX:
+            raise ValueError("Debounce time must be between 0 and {} ms".format(_DEBOUNCE_MAX * _DEBOUNCE_UNIT))
+
+        desired = self._shadow_read(addr=_DEBOUNCE_TIME)
+        desired[0] = count
+        self._shadow_write(_DEBOUNCE_TIME, desired)
+
+    def monitor(self, rate=100, ios=[0,1]):
+        """Create a GPIOEdgeMonitor watching the inputs of this Hub."""
+        return GPIOEdgeMonitor([self], rate=rate, ios=ios)
+
+    def set_pins(self, io0=None, io1=None):
+        """Set one or both outputs in a single register write.  Pins given as None are left unchanged."""
+        desired = self._shadow_read(addr=_OUTPUT)
+
+        if io0 is not None:
+            if not self._io0_output_config:
+                logging.warn("IO0 is not configured as an output, but is being set")
+
+            desired[_GPIO0_BIT[0]] = set_bit_to(desired[_GPIO0_BIT[0]], _GPIO0_BIT[1], io0)
+
+        if io1 is not None:
+            if not self._io1_output_config:
+                logging.warn("IO1 is not configured as an output, but is being set")
+
+            desired[_GPIO1_BIT[0]] = set_bit_to(desired[_GPIO1_BIT[0]], _GPIO1_BIT[1], io1)
+
+        self._shadow_write(_OUTPUT, desired)
 
     @property
     def io(self):
@@ -137,15 +279,7 @@ class USBHubGPIO:
 
     @io0.setter
     def io0(self, value):
-        if not self._io0_output_config:
-            logging.warn("IO0 is not configured as an output, but is being set")
-
-        current = self._read(addr=_OUTPUT)
-        desired = current.copy()
-        desired[_GPIO0_BIT[0]] = set_bit_to(desired[_GPIO0_BIT[0]], _GPIO0_BIT[1], value)
-
-        if current != desired:
-            self.hub.register_write(addr=_OUTPUT, buf=desired)
+        self.set_pins(io0=value)
 
     @property
     def io1(self):
@@ -157,12 +291,55 @@ class USBHubGPIO:
 
     @io1.setter
     def io1(self, value):
-        if not self._io1_output_config:
-            logging.warn("IO1 is not configured as an output, but is being set")
+        self.set_pins(io1=value)
+
+
+class GPIOEdgeMonitor(PollingEventSource):
+    """Background poller which turns GPIO input changes into timestamped edge events.
+
+    Many Hubs can be watched by one monitor; every GPIO object passed in is
+    sampled once per period.  Callbacks can be limited to an IO or edge type,
+    e.g. add_callback(callback, io=0, edge="rising").
+    """
+
+    name = "usbhub-gpio-monitor"
+
+    def __init__(self, gpios, rate=100, ios=[0,1], queue_size=1024):
+        super().__init__(1.0 / float(rate), queue_size=queue_size)
+
+        self.gpios = list(gpios)
+        self.ios = ios
+        self._last = [None] * len(self.gpios)
+
+    def poll(self):
+        """Sample every watched Hub once, emitting and returning any edges found."""
+        found = []
+
+        for idx, gpio in enumerate(self.gpios):
+            try:
+                value = gpio._read(addr=_INPUT)
+            except (usb.core.USBError, OSError):
+                logging.warn("USB Error in GPIO monitor")
+                continue
+
+            timestamp = time.monotonic()
+            last = self._last[idx]
+            self._last[idx] = value
+
+            ## Skip decoding entirely when the raw register is unchanged
+            if last is None or last == value:
+                continue
+
+            for io in self.ios:
+                byte, bit = _GPIOS[io]
+                before = get_bit(last[byte], bit)
+                after  = get_bit(value[byte], bit)
+
+                if before == after:
+                    continue
 
-        current = self._read(addr=_OUTPUT)
-        desired = current.copy()
-        desired[_GPIO1_BIT[0]] = set_bit_to(desired[_GPIO1_BIT[0]], _GPIO1_BIT[1], value)
+                event = GPIOEdge(timestamp, gpio.hub.key, io, "rising" if after else "falling")
+                found.append(event)
+                self._emit(event)
 
-        if current != desired:
-            self.hub.register_write(addr=_OUTPUT, buf=desired)
+        return found
@@ -37,10 +37,12 @@ import usb.util
 
 from .registers import registers
 from .device import USBHubDevice
+from .watch import RegisterWatch
+from .ports import PortMonitor
+from .scheduler import PortScheduler
+from .budget import PowerBudget
 from .util import *
 
-PORT_MAP = ["port2", "port4", "port1", "port3"]
-
 REGISTER_NEEDS_PORT_REMAP = [
     'port::connection',
     'port::device_speed'
@@ -264,6 +266,12 @@ class USBHub:
     def data_disable(self, ports=[]):
         return self.device.data_disable(ports)
 
+    def wait_for_enumeration(self, port, timeout=5.0, speed=None, sysfs=False, since=None):
+        return self.device.wait_for_enumeration(port, timeout=timeout, speed=speed, sysfs=sysfs, since=since)
+
+    def apply_port_state(self, states):
+        return self.device.apply_port_state(states)
+
     def register_read(self, name=None, addr=None, length=1, print=False, endian='big'):
         return self.device.register_read(name, addr, length, print, endian)
 
@@ -291,6 +299,22 @@ class USBHub:
         return self.device.config
     
 
+    def watch(self, registers, **kwargs):
+        """Create a RegisterWatch over the given registers of every attached Hub."""
+        return RegisterWatch(list(self.devices.values()), registers, **kwargs)
+
+    def port_monitor(self, rate=20):
+        """Create a PortMonitor covering every attached Hub."""
+        return PortMonitor(list(self.devices.values()), rate=rate)
+
+    def scheduler(self, tick=0.002):
+        """Create a PortScheduler covering every attached Hub."""
+        return PortScheduler(list(self.devices.values()), tick=tick)
+
+    def power_budget(self, budget, **kwargs):
+        """Create a PowerBudget controller covering every attached Hub.  Call 'start' on it to begin regulating."""
+        return PowerBudget(list(self.devices.values()), budget, **kwargs)
+
     def print_permission_instructions(self):
         message = ['User has insufficient permissions to access the USB Hub.']
 
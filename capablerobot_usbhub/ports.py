@@ -0,0 +1,217 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import os
+import time
+from collections import namedtuple
+
+import usb.core
+
+from .util import *
+from .events import PollingEventSource
+
+## The connection and device speed registers are adjacent, so both are read at once
+REG_CONNECTION = 0x3194
+REG_CONNECTION_LENGTH = 2
+
+SPEEDS = ['none', 'low', 'full', 'high']
+
+## Physical port number for each logical port 1 thru 4
+_PORT_PHYSICAL = [PORT_MAP.index("port{}".format(port)) + 1 for port in [1,2,3,4]]
+
+## 'event' is 'attached' or 'detached'; 'speed' is 'none' for detach events
+PortEvent = namedtuple('PortEvent', ['timestamp', 'key', 'port', 'event', 'speed'])
+
+## Times are seconds from the start of the wait.  'sysfs' is None when the device node was not waited for.
+Enumeration = namedtuple('Enumeration', ['port', 'speed', 'link', 'sysfs', 'path'])
+
+SYSFS_USB = "/sys/bus/usb/devices"
+
+class EnumerationTimeoutError(TimeoutError):
+    """Raised when a downstream port does not enumerate in time."""
+
+    def __init__(self, port, stage, waited):
+        super().__init__("Port {} {} not ready after {:.3f} s".format(port, stage, waited))
+        self.port = port
+        self.stage = stage
+        self.waited = waited
+
+def decode_link(data):
+    """Convert raw connection & speed register bytes to per-port (connected, speed) lists, in logical port order."""
+    connected = []
+    speeds = []
+
+    for raw in _PORT_PHYSICAL:
+        connected.append(get_bit(data[0], raw))
+        speeds.append(SPEEDS[(data[1] >> ((raw-1) * 2)) & 0b11])
+
+    return connected, speeds
+
+class PortMonitor(PollingEventSource):
+    """Emits PortEvents as devices attach to and detach from downstream ports.
+
+    Each poll costs one register read per Hub.  A port counts as attached once 
+    it reports a connection and a negotiated speed, and as detached once the 
+    connection is gone.  Events are available through callbacks (which can be
+    limited with e.g. add_callback(callback, port=2, event="attached")), the
+    blocking 'events' iterator, or 'async for' iteration.
+    """
+
+    name = "usbhub-port-monitor"
+
+    def __init__(self, devices, rate=20, queue_size=1024):
+        super().__init__(1.0 / float(rate), queue_size=queue_size)
+
+        if not isinstance(devices, (list, tuple)):
+            devices = [devices]
+
+        self.devices = list(devices)
+        self._raw = [None] * len(self.devices)
+        self._attached = [None] * len(self.devices)
+
+    def state(self):
+        """Return, per Hub key, the attached speed of each port (None for unattached ports) as of the last poll."""
+        out = {}
+
+        for idx, device in enumerate(self.devices):
+            if self._attached[idx] is not None:
+                out[device.key] = list(self._attached[idx])
+
+        return out
+
+    def poll(self):
+        """Read every Hub once, emitting and returning any attach / detach events."""
+        found = []
+
+        for idx, device in enumerate(self.devices):
+            try:
+                data = device.register_read_raw(REG_CONNECTION, REG_CONNECTION_LENGTH)
+            except (usb.core.USBError, OSError, ValueError):
+                logging.warn("USB Error in port monitor")
+                continue
+
+            timestamp = time.monotonic()
+
+            if data == self._raw[idx]:
+                continue
+
+            self._raw[idx] = data
+            connected, speeds = decode_link(data)
+
+            attached = [speed if connection and speed != 'none' else None for connection, speed in zip(connected, speeds)]
+            previous = self._attached[idx]
+            self._attached[idx] = attached
+
+            ## First sample only establishes the starting state
+            if previous is None:
+                continue
+
+            for port in [1,2,3,4]:
+                before = previous[port-1]
+                after = attached[port-1]
+
+                if before is None and after is not None:
+                    found.append(PortEvent(timestamp, device.key, port, 'attached', after))
+                elif before is not None and after is None and not connected[port-1]:
+                    found.append(PortEvent(timestamp, device.key, port, 'detached', 'none'))
+                elif before is not None and after is None:
+                    ## Connected but speed not reported; keep treating the port as attached
+                    attached[port-1] = before
+
+        for event in found:
+            self._emit(event)
+
+        return found
+
+
+def sysfs_path(device, port):
+    """Return the Linux sysfs directory a device attached to the given downstream port will appear at.
+
+    Names follow the kernel's '<bus>-<port>.<port>...' scheme.  The USB handle
+    is the Hub Feature Controller, which sits on an internal port of the Hub,
+    so the last entry of its port path is dropped to get the Hub's own path,
+    which is then extended with the physical port number of the Hub IC.
+    """
+    ports = list(device.handle.port_numbers or [])[:-1]
+    ports.append(_PORT_PHYSICAL[port-1])
+
+    name = "{}-{}".format(device.handle.bus, ".".join(str(p) for p in ports))
+    return os.path.join(SYSFS_USB, name)
+
+def wait_for_enumeration(device, port, timeout=5.0, speed=None, sysfs=False, interval=0.005, since=None):
+    """Block until the downstream port reports a connection at a negotiated speed and return an Enumeration.
+
+    When 'speed' is given, waits for that specific speed.  With 'sysfs' set, 
+    also waits for the Linux device node of the port to appear.  Timing is
+    measured from 'since' (a time.monotonic() value, for instance taken just 
+    before the port was enabled), or from the call when not given.
+    """
+    if port not in [1,2,3,4]:
+        raise ValueError("Port must be between 1 and 4")
+
+    if speed is not None and speed not in SPEEDS[1:]:
+        raise ValueError("Speed must be one of {}".format(", ".join(SPEEDS[1:])))
+
+    start = time.monotonic() if since is None else since
+    deadline = start + timeout
+    now = time.monotonic()
+
+    while True:
+        try:
+            data = device.register_read_raw(REG_CONNECTION, REG_CONNECTION_LENGTH)
+        except usb.core.USBError:
+            ## The Hub can briefly stall control requests while a port is switched
+            logging.warn("USB Error while waiting for port enumeration")
+        else:
+            now = time.monotonic()
+            connected, speeds = decode_link(data)
+            found = speeds[port-1]
+
+            if connected[port-1] and found != 'none' and (speed is None or found == speed):
+                break
+
+        if now >= deadline:
+            raise EnumerationTimeoutError(port, 'link', now - start)
+
+        time.sleep(min(interval, max(0, deadline - now)))
+        now = time.monotonic()
+
+    link = now - start
+
+    if not sysfs:
+        return Enumeration(port, found, link, None, None)
+
+    path = sysfs_path(device, port)
+    delay = 0.001
+
+    ## The kernel creates the node after its own enumeration, which can take a
+    ## few hundred ms, so back off rather than polling the filesystem quickly.
+    while not os.path.exists(path):
+        now = time.monotonic()
+        if now >= deadline:
+            raise EnumerationTimeoutError(port, 'sysfs node', now - start)
+
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, 0.05)
+
+    return Enumeration(port, found, link, time.monotonic() - start, path)
@@ -20,7 +20,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import time
+
 from .util import *
+from .sampler import PowerSampler
+from .energy import EnergyMeter
+from .filters import MovingAverage, MedianFilter, ExponentialAverage
 
 ADDR_USC12 = 0x57
 ADDR_USC34 = 0x56
@@ -36,6 +41,9 @@ _CONFIG1       = 0x11
 _CONFIG2       = 0x12
 _CURRENT_LIMIT = 0x14
 
+## Scale from 8 bit current reading to mA
+TO_MA = 13.3
+
 _CURRENT_MAPPING = [
     530,
     960,
@@ -47,6 +55,90 @@ _CURRENT_MAPPING = [
     3200
 ]
 
+def _decode_measure(value):
+    ## Mailbox measurement parameters hold two 8 bit readings, first port in the LSB
+    return [float(value & 0xFF) * TO_MA, float((value >> 8) & 0xFF) * TO_MA]
+
+def _decode_limits(value):
+    ## 'power_limits' holds a 3 bit setting per port, two ports per byte
+    port12 = value & 0xFF
+    port34 = (value >> 8) & 0xFF
+
+    out = [port12 & 0b111, (port12 >> 3) & 0b111, port34 & 0b111, (port34 >> 3) & 0b111]
+    return [_CURRENT_MAPPING[key] for key in out]
+
+## Alert names for each bit (MSB first) of _PORT_STATUS, _INTERRUPT1 and _INTERRUPT2.
+## '{a}' and '{b}' are replaced by the first and second port of a switch chip, 
+## '{ab}' by both ports.  None marks bits which do not signal an alert.
+_ALERT_BITS = [
+    ["ALERT.{b}", "ALERT.{a}", "CC_MODE.{b}", "CC_MODE.{a}", None, None, None, None],
+    ["ERROR.{a}", "DISCHARGE.{a}", "RESET.{ab}", "KEEP_OUT.{a}", "DIE_TEMP_HIGH.{ab}", "OVER_VOLT.{ab}", "BACK_BIAS.{a}", "OVER_LIMIT.{a}"],
+    ["ERROR.{b}", "DISCHARGE.{b}", "VS_LOW.{ab}", "KEEP_OUT.{b}", "DIE_TEMP_LOW.{ab}", None, "BACK_BIAS.{b}", "OVER_LIMIT.{b}"],
+]
+
+_ALERT_BYTES = len(_ALERT_BITS)
+
+def _build_alert_table():
+    ## For each of the six alert bytes (3 per switch chip), map every possible
+    ## register value to the tuple of alert names it represents.
+    table = []
+
+    for idx in range(2):
+        ports = dict(a=idx*2+1, b=idx*2+2, ab="{}{}".format(idx*2+1, idx*2+2))
+
+        for names in _ALERT_BITS:
+            names = [None if name is None else name.format(**ports) for name in names]
+            table.append([tuple(names[7-bit] for bit in range(7, -1, -1) if get_bit(value, bit) and names[7-bit] is not None) for value in range(256)])
+
+    return table
+
+_ALERT_TABLE = _build_alert_table()
+
+class PowerAlerts:
+    """Decoded power alerts of both switch chips.
+
+    Behaves like the list of alert names returned by earlier versions
+    (iteration, len, 'in'), with the raw register bytes in 'raw' and a
+    48 bit mask of every asserted flag in 'mask'.
+    """
+
+    def __init__(self, raw):
+        self.raw = bytes(raw)
+        self.mask = int.from_bytes(self.raw, 'big')
+        self._names = None
+
+    @property
+    def names(self):
+        if self._names is None:
+            names = ()
+            for idx, value in enumerate(self.raw):
+                names += _ALERT_TABLE[idx][value]
+            self._names = list(names)
+
+        return self._names
+
+    def port(self, port):
+        """Alerts which apply to a given port, including those shared by both ports of a chip."""
+        return [name for name in self.names if str(port) in name.split(".")[1]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __eq__(self, other):
+        if isinstance(other, PowerAlerts):
+            return self.raw == other.raw
+
+        return self.names == other
+
+    def __repr__(self):
+        return "PowerAlerts({})".format(self.names)
+
 class USBHubPower:
 
     def __init__(self, hub):
@@ -75,9 +167,33 @@ class USBHubPower:
 
         return self._control_registers[port]
 
+    def sampler(self, rate=10, size=4096):
+        """Create a PowerSampler for this Hub.  Call 'start' on it to begin sampling."""
+        return PowerSampler(self, rate=rate, size=size)
+
+    def energy_meter(self, sampler=None, voltage=5.0):
+        """Create an EnergyMeter integrating the samples of 'sampler' (by default a new 10 Hz PowerSampler)."""
+        if sampler is None:
+            sampler = self.sampler()
+
+        return EnergyMeter(sampler, voltage=voltage)
+
+    def _control_values(self):
+        ## The port control registers are 4 bytes apart, so a single
+        ## read spanning all of them is cheaper than one read per port
+        addrs = [self.control_register(idx) for idx in range(4)]
+        start = min(addrs)
+
+        data, _ = self.hub.register_read(addr=start, length=max(addrs)-start+1)
+        return [data[addr-start] for addr in addrs]
+
     def state(self, ports=[1,2,3,4]):
         out = []
 
+        if len(ports) > 1:
+            values = self._control_values()
+            return [get_bit(values[port-1], 0) for port in ports]
+
         for port in ports:
             data, _ = self.hub.register_read(addr=self.control_register(port-1))
             out.append(get_bit(data[0], 0))
@@ -93,25 +209,27 @@ class USBHubPower:
             self.hub.register_write(addr=self.control_register(port-1), buf=[0x81])
 
     def measurements(self, ports=[1,2,3,4]):
-        TO_MA = 13.3
-
         out = []
 
         if self.hub.config.version > 1:
+            names = []
+
             if 1 in ports or 2 in ports:
-                data = self.hub.config.get("power_measure_12")
-                if 1 in ports:
-                    out.append(float(data & 0xFF) * TO_MA)
-                if 2 in ports:
-                    out.append(float((data >> 8) & 0xFF ) * TO_MA)
+                names.append("power_measure_12")
 
             if 3 in ports or 4 in ports:
-                data = self.hub.config.get("power_measure_34")
-                if 3 in ports:
-                    out.append(float(data & 0xFF) * TO_MA)
-                if 4 in ports:
-                    out.append(float((data >> 8) & 0xFF ) * TO_MA)
-            
+                names.append("power_measure_34")
+
+            values = self.hub.config.get_many(names)
+
+            if 1 in ports or 2 in ports:
+                data = _decode_measure(values["power_measure_12"])
+                out += [data[port-1] for port in [1,2] if port in ports]
+
+            if 3 in ports or 4 in ports:
+                data = _decode_measure(values["power_measure_34"])
+                out += [data[port-3] for port in [3,4] if port in ports]
+
             return out
 
         for port in ports:
@@ -130,20 +248,76 @@ class USBHubPower:
 
         return out
 
-    def limits(self):
-        out = []
+    def _raw_currents(self, path, pairs):
+        ## One reading of the 8 bit current counts of ports 1 thru 4 (None for pairs not read)
+        out = [None] * 4
 
-        if self.hub.config.version > 1:
-            value = self.hub.config.get("power_limits")
+        if path == 'mailbox':
+            names = ["power_measure_12", "power_measure_34"]
+            values = self.hub.config.get_many([names[pair] for pair in pairs])
 
-            port12 = value & 0xFF
-            port34 = (value >> 8) & 0xFF
+            for pair in pairs:
+                value = values[names[pair]]
+                out[pair*2:pair*2+2] = [value & 0xFF, (value >> 8) & 0xFF]
+        else:
+            ## Both current registers of a switch chip are adjacent, so one block read covers its two ports
+            for pair in pairs:
+                i2c_addr = [ADDR_USC12, ADDR_USC34][pair]
+                out[pair*2:pair*2+2] = self.i2c.read_i2c_block_data(i2c_addr, _PORT1_CURRENT, number=2)[0:2]
+
+        return out
+
+    def oversample(self, ports=[1,2,3,4], samples=16, filter='mean', path=None, interval=0):
+        """Take a burst of 'samples' current readings and return a filtered Measurement (in mA) per port.
+
+        'filter' is 'mean', 'median' or 'ema', or a filter instance from the 
+        filters module (whose state then carries over between calls).  'path' 
+        is 'mailbox' or 'i2c', and defaults to the path 'measurements' uses.
+        Readings are 'interval' seconds apart.
+
+        Averaging only resolves below the 13.3 mA step of a single reading when
+        the readings have some noise to dither them.  When they do not, the 
+        uncertainty reports the quantization limit instead.
+        """
+        if samples < 1:
+            raise ValueError("At least one sample must be taken")
+
+        for port in ports:
+            if port not in [1,2,3,4]:
+                raise ValueError("Port must be between 1 and 4")
+
+        if path is None:
+            path = 'mailbox' if self.hub.config.version > 1 else 'i2c'
+
+        if path not in ['mailbox', 'i2c']:
+            raise ValueError("Path must be 'mailbox' or 'i2c'")
+
+        if filter == 'mean':
+            filter = MovingAverage(window=samples, resolution=TO_MA)
+        elif filter == 'median':
+            filter = MedianFilter(window=samples, resolution=TO_MA)
+        elif filter == 'ema':
+            filter = ExponentialAverage(alpha=2.0/(samples+1), resolution=TO_MA)
+        elif isinstance(filter, str):
+            raise ValueError("Filter must be 'mean', 'median', 'ema' or a filter instance")
 
-            out.append(port12 & 0b111)
-            out.append((port12 >> 3) & 0b111)
+        pairs = sorted(set((port-1) // 2 for port in ports))
+        result = None
 
-            out.append(port34 & 0b111)
-            out.append((port34 >> 3) & 0b111)
+        for idx in range(samples):
+            if idx > 0 and interval > 0:
+                time.sleep(interval)
+
+            raw = self._raw_currents(path, pairs)
+            result = filter.update([0 if value is None else value * TO_MA for value in raw])
+
+        return [result[port-1] for port in ports]
+
+    def limits(self):
+        out = []
+
+        if self.hub.config.version > 1:
+            return _decode_limits(self.hub.config.get("power_limits"))
         else:
             reg_addr = _CURRENT_LIMIT
 
@@ -219,90 +393,11 @@ class USBHubPower:
                 self.i2c.write_bytes(ADDR_USC34, bytes([reg_addr, int(value)]))
 
     def alerts(self):
-        out = []
-
-        for idx, i2c_addr in enumerate([ADDR_USC12, ADDR_USC34]):
-
-            value = self.i2c.read_i2c_block_data(i2c_addr, _PORT_STATUS, number=1)[0]
-
-            if get_bit(value, 7):
-                out.append("ALERT.{}".format(idx*2+2))
-
-            if get_bit(value, 6):
-                out.append("ALERT.{}".format(idx*2+1))
-
-            if get_bit(value, 5):
-                out.append("CC_MODE.{}".format(idx*2+2))
-
-            if get_bit(value, 4):
-                out.append("CC_MODE.{}".format(idx*2+1))
-
-
-            value = self.i2c.read_i2c_block_data(i2c_addr, _INTERRUPT1, number=1)[0]
-
-            if get_bit(value, 7):
-                out.append("ERROR.{}".format(idx*2+1))
-
-            if get_bit(value, 6):
-                out.append("DISCHARGE.{}".format(idx*2+1))
-
-            if get_bit(value, 5):
-                if idx == 0:
-                    out.append("RESET.12")
-                else:
-                    out.append("RESET.34")
-
-            if get_bit(value, 4):
-                out.append("KEEP_OUT.{}".format(idx*2+1))
-
-            if get_bit(value, 3):
-                if idx == 0:
-                    out.append("DIE_TEMP_HIGH.12")
-                else:
-                    out.append("DIE_TEMP_HIGH.34")
-
-            if get_bit(value, 2):
-                if idx == 0:
-                    out.append("OVER_VOLT.12")
-                else:
-                    out.append("OVER_VOLT.34")
-
-            if get_bit(value, 1):
-                out.append("BACK_BIAS.{}".format(idx*2+1))
-
-            if get_bit(value, 0):
-                out.append("OVER_LIMIT.{}".format(idx*2+1))
-
-
-            value = self.i2c.read_i2c_block_data(i2c_addr, _INTERRUPT2, number=1)[0]
-
-            if get_bit(value, 7):
-                out.append("ERROR.{}".format(idx*2+2))
-
-            if get_bit(value, 6):
-                out.append("DISCHARGE.{}".format(idx*2+2))
-
-            if get_bit(value, 5):
-                if idx == 0:
-                    out.append("VS_LOW.12")
-                else:
-                    out.append("VS_LOW.34")
-
-            if get_bit(value, 4):
-                out.append("KEEP_OUT.{}".format(idx*2+2))
-
-            if get_bit(value, 3):
-                if idx == 0:
-                    out.append("DIE_TEMP_LOW.12")
-                else:
-                    out.append("DIE_TEMP_LOW.34")
-
-            ## Bit 2 is unimplemented
-
-            if get_bit(value, 1):
-                out.append("BACK_BIAS.{}".format(idx*2+2))
+        data = []
 
-            if get_bit(value, 0):
-                out.append("OVER_LIMIT.{}".format(idx*2+2))
+        ## _PORT_STATUS, _INTERRUPT1 and _INTERRUPT2 are adjacent, so
+        ## one block read per switch chip fetches all three registers
+        for i2c_addr in [ADDR_USC12, ADDR_USC34]:
+            data += self.i2c.read_i2c_block_data(i2c_addr, _PORT_STATUS, number=_ALERT_BYTES)[0:_ALERT_BYTES]
 
-        return out
\ No newline at end of file
+        return PowerAlerts(data)
@@ -0,0 +1,407 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import csv
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+## File layout
+##
+##   header : magic, version, record format, field names, records per block
+##   block  : block marker with the timestamp of its first record, 
+##            followed by up to 'block_records' fixed-width records
+##
+## All blocks but the last are full, so the offset of any block can be computed
+## directly.  Readers binary search block start times, then records within a
+## block, to locate a time range without scanning the file.
+
+_MAGIC = b'CRUHTLM\x00'
+_VERSION = 1
+
+_HEADER = struct.Struct('<8sHHHH')
+_BLOCK  = struct.Struct('<4sd')
+_BLOCK_MAGIC = b'BLK0'
+
+_RECORD_FORMAT = '<d4f5B3x'
+_RECORD_FIELDS = 'timestamp,current1,current2,current3,current4,valid,power,data,connections,speeds'
+
+_VALID_CURRENT     = 0b00001
+_VALID_POWER       = 0b00010
+_VALID_DATA        = 0b00100
+_VALID_CONNECTIONS = 0b01000
+_VALID_SPEEDS      = 0b10000
+
+_SPEEDS = ['none', 'low', 'full', 'high']
+
+TelemetryRecord = namedtuple('TelemetryRecord', ['timestamp', 'currents', 'power', 'data', 'connections', 'speeds'])
+
+def _pack_bools(values):
+    out = 0
+
+    for idx, value in enumerate(values):
+        if value:
+            out |= 1 << idx
+
+    return out
+
+def _unpack_bools(value, valid):
+    if not valid:
+        return None
+
+    return [(value >> idx) & 1 == 1 for idx in range(4)]
+
+class TelemetryRecorder:
+    """Appends fixed-width binary telemetry records to a file.
+
+    Timestamps are wall-clock seconds (time.time()) so that recordings from
+    different runs can be queried by absolute time.  Writes go through the file
+    buffer; 'flush' pushes them to the OS and is also done every 'flush_interval'
+    seconds.  Pass 'sync=True' to also fsync on each flush.
+    """
+
+    def __init__(self, path, block_records=256, flush_interval=1.0, sync=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.sync = sync
+
+        self._record = struct.Struct(_RECORD_FORMAT)
+        self._last_flush = time.monotonic()
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            ## Appending to an existing recording, so reuse its block size and 
+            ## continue filling the last (possibly partial) block.
+            reader = TelemetryReader(path)
+            self.block_records = reader.block_records
+            self._in_block = reader._block_count(reader.blocks - 1) if reader.blocks > 0 else 0
+            size = reader._end
+            reader.close()
+
+            self._file = open(path, 'r+b')
+            self._file.truncate(size)
+            self._file.seek(size)
+        else:
+            self.block_records = block_records
+            self._in_block = 0
+
+            self._file = open(path, 'wb')
+            fmt = _RECORD_FORMAT.encode('ascii')
+            fields = _RECORD_FIELDS.encode('ascii')
+            self._file.write(_HEADER.pack(_MAGIC, _VERSION, len(fmt), len(fields), block_records))
+            self._file.write(fmt)
+            self._file.write(fields)
+
+        if self._in_block == 0:
+            self._in_block = self.block_records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def record(self, timestamp=None, currents=None, power=None, data=None, connections=None, speeds=None):
+        """Append a record.  Any of the measurements may be None if they were not sampled."""
+        if timestamp is None:
+            timestamp = time.time()
+
+        valid = 0
+
+        if currents is None:
+            currents = [0.0] * 4
+        else:
+            valid |= _VALID_CURRENT
+
+        if power is None:
+            power = 0
+        else:
+            valid |= _VALID_POWER
+            power = _pack_bools(power)
+
+        if data is None:
+            data = 0
+        else:
+            valid |= _VALID_DATA
+            data = _pack_bools([value == "on" if isinstance(value, str) else value for value in data])
+
+        if connections is None:
+            connections = 0
+        else:
+            valid |= _VALID_CONNECTIONS
+            connections = _pack_bools(connections)
+
+        if speeds is None:
+            speeds = 0
+        else:
+            valid |= _VALID_SPEEDS
+            packed = 0
+
+            for idx, value in enumerate(speeds):
+                if isinstance(value, str):
+                    value = _SPEEDS.index(value)
+                packed |= (value & 0b11) << (idx * 2)
+
+            speeds = packed
+
+        if self._in_block >= self.block_records:
+            self._file.write(_BLOCK.pack(_BLOCK_MAGIC, timestamp))
+            self._in_block = 0
+
+        self._file.write(self._record.pack(timestamp, *currents[0:4], valid, power, data, connections, speeds))
+        self._in_block += 1
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def record_device(self, device, state=True):
+        """Query a USBHubDevice and record its currents, and optionally its power, data & connection state."""
+        currents = device.power.measurements()
+
+        if not state:
+            self.record(currents=currents)
+            return
+
+        ## 'connections' also reports the Hub's internal port 0, so read the link
+        ## state directly as logical ports 1 thru 4 (one read covers both fields)
+        connections, speeds = device._port_link()
+
+        self.record(
+            currents    = currents,
+            power       = device.power.state(),
+            data        = device.data_state(),
+            connections = connections,
+            speeds      = speeds
+        )
+
+    def on_sample(self, sample):
+        """PowerSampler callback.  Sampler timestamps are monotonic, so wall-clock time is recorded instead."""
+        self.record(currents=sample.values)
+
+    def flush(self):
+        self._file.flush()
+
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        if self._file is None:
+            return
+
+        self.flush()
+        self._file.close()
+        self._file = None
+
+class TelemetryReader:
+    """Memory-mapped reader for files written by TelemetryRecorder."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, fmt_len, fields_len, block_records = _HEADER.unpack_from(self._map, 0)
+
+        if magic != _MAGIC:
+            raise ValueError("{} is not a telemetry recording".format(path))
+
+        if version != _VERSION:
+            raise ValueError("Unsupported telemetry recording version {}".format(version))
+
+        offset = _HEADER.size
+        self.format = self._map[offset:offset+fmt_len].decode('ascii')
+        offset += fmt_len
+        self.fields = self._map[offset:offset+fields_len].decode('ascii').split(",")
+        offset += fields_len
+
+        self.block_records = block_records
+
+        self._record = struct.Struct(self.format)
+        self._start = offset
+        self._block_size = _BLOCK.size + block_records * self._record.size
+
+        ## A recording which was interrupted mid-write may end in a partial 
+        ## record or a bare block marker; that tail is ignored.
+        body = len(self._map) - self._start
+        self.blocks, remainder = divmod(body, self._block_size)
+        self._last_count = self.block_records if self.blocks > 0 else 0
+
+        if remainder >= _BLOCK.size + self._record.size:
+            self.blocks += 1
+            self._last_count = (remainder - _BLOCK.size) // self._record.size
+
+        self._end = self._start
+
+        if self.blocks > 0:
+            self._end += (self.blocks - 1) * self._block_size + _BLOCK.size + self._last_count * self._record.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        if self.blocks == 0:
+            return 0
+
+        return (self.blocks - 1) * self.block_records + self._last_count
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+
+        if idx < 0 or idx >= len(self):
+            raise IndexError("Record index out of range")
+
+        return self._decode(self._raw(idx))
+
+    def close(self):
+        if self._map is None:
+            return
+
+        self._map.close()
+        self._file.close()
+        self._map = None
+
+    def _block_count(self, block):
+        if block == self.blocks - 1:
+            return self._last_count
+
+        return self.block_records
+
+    def _offset(self, idx):
+        block, pos = divmod(idx, self.block_records)
+        return self._start + block * self._block_size + _BLOCK.size + pos * self._record.size
+
+    def _raw(self, idx):
+        return self._record.unpack_from(self._map, self._offset(idx))
+
+    def _timestamp(self, idx):
+        return struct.unpack_from('<d', self._map, self._offset(idx))[0]
+
+    def _block_timestamp(self, block):
+        return _BLOCK.unpack_from(self._map, self._start + block * self._block_size)[1]
+
+    def _decode(self, raw):
+        timestamp = raw[0]
+        currents = list(raw[1:5])
+        valid, power, data, connections, speeds = raw[5:10]
+
+        if not valid & _VALID_CURRENT:
+            currents = None
+
+        data = _unpack_bools(data, valid & _VALID_DATA)
+        if data is not None:
+            data = ["on" if value else "off" for value in data]
+
+        if valid & _VALID_SPEEDS:
+            speeds = [_SPEEDS[(speeds >> (idx * 2)) & 0b11] for idx in range(4)]
+        else:
+            speeds = None
+
+        return TelemetryRecord(
+            timestamp,
+            currents,
+            _unpack_bools(power, valid & _VALID_POWER),
+            data,
+            _unpack_bools(connections, valid & _VALID_CONNECTIONS),
+            speeds
+        )
+
+    def _bisect(self, timestamp):
+        ## Index of the first record at or after 'timestamp'.  Block start
+        ## times narrow the search before individual records are examined.
+        lo, hi = 0, self.blocks
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._block_timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        block = max(0, lo - 1)
+        lo = block * self.block_records
+        hi = min(len(self), (block + 2) * self.block_records)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def range(self, start=None, end=None):
+        """Yield records with start <= timestamp < end.  Assumes timestamps were recorded in order."""
+        first = 0 if start is None else self._bisect(start)
+        last = len(self) if end is None else self._bisect(end)
+
+        for idx in range(first, last):
+            yield self._decode(self._raw(idx))
+
+    def __iter__(self):
+        return self.range()
+
+    def to_csv(self, out, start=None, end=None):
+        """Write records (optionally limited to a time range) as CSV to a path or file object."""
+        if isinstance(out, str):
+            with open(out, 'w', newline='') as handle:
+                return self.to_csv(handle, start, end)
+
+        ports = [1,2,3,4]
+        writer = csv.writer(out)
+        writer.writerow(
+            ['timestamp'] + 
+            ["port{}_ma".format(port) for port in ports] +
+            ["port{}_power".format(port) for port in ports] +
+            ["port{}_data".format(port) for port in ports] +
+            ["port{}_connected".format(port) for port in ports] +
+            ["port{}_speed".format(port) for port in ports]
+        )
+
+        count = 0
+
+        for record in self.range(start, end):
+            row = ["%.6f" % record.timestamp]
+
+            if record.currents is None:
+                row += [""] * 4
+            else:
+                row += ["%.2f" % value for value in record.currents]
+
+            for values in [record.power, record.data, record.connections, record.speeds]:
+                if values is None:
+                    row += [""] * 4
+                else:
+                    row += [int(value) if isinstance(value, bool) else value for value in values]
+
+            writer.writerow(row)
+            count += 1
+
+        return count
@@ -0,0 +1,163 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import array
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import usb.core
+
+from .util import *
+from .events import PollingEventSource
+
+## Each record is a timestamp followed by the current of ports 1 thru 4
+_FIELDS = 5
+
+## One sample of the current (mA) of ports 1 thru 4, with a time.monotonic() timestamp
+PowerSample = namedtuple('PowerSample', ['timestamp', 'values'])
+
+class PowerSampler(PollingEventSource):
+    """Samples port currents at a fixed rate into a preallocated ring buffer.
+
+    Records are (timestamp, port1, port2, port3, port4) with a time.monotonic()
+    timestamp and currents in mA.  Once the buffer is full the oldest records
+    are overwritten.  Each sample is also emitted as a PowerSample event, so
+    is available to callbacks and the 'events' iterators.
+    """
+
+    name = "usbhub-power-sampler"
+
+    def __init__(self, power, rate=10, size=4096, queue_size=1024):
+        super().__init__(1.0 / float(rate), queue_size=queue_size)
+
+        self.power = power
+        self.size = size
+
+        self._data = array.array('d', bytes(8 * _FIELDS * size))
+        self._head = 0
+        self._count = 0
+        self._lock = threading.RLock()
+
+        self.errors = 0
+
+    def __len__(self):
+        return self._count
+
+    def clear(self):
+        with self._lock:
+            self._head = 0
+            self._count = 0
+
+    def append(self, timestamp, values):
+        with self._lock:
+            offset = self._head * _FIELDS
+            self._data[offset] = timestamp
+
+            for idx in range(_FIELDS - 1):
+                self._data[offset + 1 + idx] = values[idx]
+
+            self._head = (self._head + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+        self._emit(PowerSample(timestamp, values))
+
+    def sample(self):
+        try:
+            values = self.power.measurements()
+        except (usb.core.USBError, OSError):
+            self.errors += 1
+            logging.warn("USB Error in power sampler")
+            return None
+
+        timestamp = time.monotonic()
+        self.append(timestamp, values)
+
+        return PowerSample(timestamp, values)
+
+    def poll(self):
+        result = self.sample()
+
+        if result is None:
+            return []
+
+        return [result]
+
+    def view(self):
+        """Return zero-copy memoryviews of the buffered records, oldest first.
+
+        Each view is shaped (rows, 5).  At most two views are returned, as the 
+        ring buffer may wrap.  The views alias the live buffer, so records can be
+        overwritten by the sampling thread while they are held.
+        """
+        with self._lock:
+            head = self._head
+            count = self._count
+
+        flat = memoryview(self._data)
+        start = (head - count) % self.size
+
+        if start + count <= self.size:
+            spans = [(start, start + count)]
+        else:
+            spans = [(start, self.size), (0, head)]
+
+        return [flat[a*_FIELDS:b*_FIELDS].cast('B').cast('d', [b-a, _FIELDS]) for a, b in spans if b > a]
+
+    def records(self, window=None):
+        """Return a copy of the buffered records as a list of tuples, optionally only the last 'window' seconds."""
+        with self._lock:
+            out = []
+            for view in self.view():
+                out.extend(tuple(row) for row in view.tolist())
+
+        if window is not None and len(out) > 0:
+            cutoff = out[-1][0] - window
+            out = [row for row in out if row[0] >= cutoff]
+
+        return out
+
+    def stats(self, window=None):
+        """Return per-port dicts of min / max / mean / p99 over the buffered (or windowed) records."""
+        rows = self.records(window)
+        return [summarize(row[idx] for row in rows) for idx in range(1, _FIELDS)]
+
+    def to_numpy(self, window=None):
+        """Return the buffered records as a (rows, 5) NumPy array.  Requires NumPy to be installed."""
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("NumPy is required for PowerSampler.to_numpy")
+
+        with self._lock:
+            views = self.view()
+
+            if len(views) == 0:
+                out = numpy.empty((0, _FIELDS))
+            else:
+                out = numpy.concatenate([numpy.frombuffer(view, dtype=numpy.float64).reshape(-1, _FIELDS) for view in views])
+
+        if window is not None and len(out) > 0:
+            out = out[out[:, 0] >= out[-1, 0] - window]
+
+        return out
@@ -0,0 +1,285 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from .util import *
+
+ACTIONS = ['power_on', 'power_off', 'data_on', 'data_off']
+
+## 'offset' is seconds from the start of the plan
+ScheduledAction = namedtuple('ScheduledAction', ['offset', 'key', 'action', 'ports'])
+
+## 'target' and 'executed' are seconds from the start of the plan, 'jitter' is their difference
+ActionResult = namedtuple('ActionResult', ['key', 'action', 'ports', 'target', 'executed', 'jitter', 'error'])
+
+class TimerWheel:
+    """Hashed timer wheel holding items against absolute deadlines.
+
+    Adding an item is O(1) regardless of how many are pending.  Items are 
+    returned by 'expire' once the wheel has advanced past their tick.
+    """
+
+    def __init__(self, tick=0.002, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.pending = 0
+
+        self._current = None
+
+    def _tick_of(self, when):
+        return int(when / self.tick)
+
+    def add(self, when, item):
+        tick = self._tick_of(when)
+
+        ## Items already due land in the next slot to be expired
+        if self._current is not None and tick < self._current:
+            tick = self._current
+
+        self.slots[tick % len(self.slots)].append((tick, when, item))
+        self.pending += 1
+
+    def expire(self, now):
+        """Return (deadline, item) pairs due up to the end of the tick containing 'now', in deadline order."""
+        target = self._tick_of(now)
+
+        if self._current is None:
+            self._current = target
+
+        due = []
+
+        ## Skipping over more than a full revolution would revisit the same slots
+        last = min(target, self._current + len(self.slots) - 1)
+
+        for tick in range(self._current, last + 1):
+            slot = self.slots[tick % len(self.slots)]
+
+            if len(slot) == 0:
+                continue
+
+            keep = []
+            for entry in slot:
+                if entry[0] <= target:
+                    due.append(entry[1:])
+                else:
+                    keep.append(entry)
+
+            slot[:] = keep
+
+        self._current = target + 1
+        self.pending -= len(due)
+
+        return sorted(due, key=lambda entry: entry[0])
+
+
+class PortScheduler:
+    """Runs timed power & data actions on the ports of one or more Hubs.
+
+    Actions are placed on a timer wheel and, when due, are handed to a worker 
+    thread per Hub so that Hubs are driven concurrently.  Actions for the same 
+    Hub which fall due on the same tick are merged into a single batch.
+
+        scheduler = PortScheduler(hub)
+        scheduler.add(0, 'power_off')
+        scheduler.stagger(0.5, 'power_on', step=0.05)
+        results = scheduler.run()
+    """
+
+    def __init__(self, devices, tick=0.002):
+        if hasattr(devices, 'devices'):
+            devices = list(devices.devices.values())
+        elif not isinstance(devices, (list, tuple)):
+            devices = [devices]
+
+        self.devices = {device.key:device for device in devices}
+        self.tick = tick
+        self.plan = []
+
+        ## time.monotonic() value which plan offsets of the last run are relative to
+        self.started = None
+
+    def _keys(self, keys):
+        if keys is None:
+            return list(self.devices.keys())
+
+        for key in keys:
+            if key not in self.devices:
+                raise ValueError("Unknown Hub : {}".format(key))
+
+        return list(keys)
+
+    def add(self, offset, action, ports=[1,2,3,4], keys=None):
+        """Schedule 'action' on the ports of the given Hubs (default all) 'offset' seconds into the plan."""
+        if action not in ACTIONS:
+            raise ValueError("Action must be one of {}".format(", ".join(ACTIONS)))
+
+        for port in ports:
+            if port not in [1,2,3,4]:
+                raise ValueError("Port must be between 1 and 4")
+
+        for key in self._keys(keys):
+            self.plan.append(ScheduledAction(float(offset), key, action, list(ports)))
+
+        return self
+
+    def stagger(self, offset, action, ports=[1,2,3,4], step=0.05, keys=None, across_hubs=False):
+        """Schedule 'action' one port at a time, 'step' seconds apart.
+
+        By default each Hub steps through its ports in parallel with the other 
+        Hubs.  With 'across_hubs' set, every port of every Hub gets its own 
+        step, which limits the total inrush current on a shared supply.
+        """
+        keys = self._keys(keys)
+        idx = 0
+
+        for key in keys:
+            if not across_hubs:
+                idx = 0
+
+            for port in ports:
+                self.add(offset + idx * step, action, ports=[port], keys=[key])
+                idx += 1
+
+        return self
+
+    def power_cycle(self, ports=[1,2,3,4], off_time=0.5, step=0.05, keys=None, across_hubs=False):
+        """Schedule all ports off at once, then back on with a stagger after 'off_time' seconds."""
+        self.add(0, 'power_off', ports=ports, keys=keys)
+        return self.stagger(off_time, 'power_on', ports=ports, step=step, keys=keys, across_hubs=across_hubs)
+
+    def clear(self):
+        self.plan = []
+
+    @property
+    def duration(self):
+        return max([action.offset for action in self.plan] + [0])
+
+    def _execute(self, device, actions):
+        ports = {action:[] for action in ACTIONS}
+
+        for entry in actions:
+            for port in entry.ports:
+                if port not in ports[entry.action]:
+                    ports[entry.action].append(port)
+
+        ## Power writes are one register write per port.  The data switches all
+        ## live in one register, so every data change in the batch is one update.
+        if len(ports['power_off']) > 0:
+            device.power.disable(ports=ports['power_off'])
+
+        if len(ports['power_on']) > 0:
+            device.power.enable(ports=ports['power_on'])
+
+        if len(ports['data_on']) > 0 or len(ports['data_off']) > 0:
+            value = device._data_state()
+
+            for port in ports['data_off']:
+                value = set_bit(value, 8-port)
+
+            for port in ports['data_on']:
+                value = clear_bit(value, 8-port)
+
+            device._data_write(value)
+
+    def _worker(self, device, jobs, start, results, lock):
+        while True:
+            job = jobs.get()
+
+            if job is None:
+                return
+
+            target, actions = job
+            error = None
+
+            ## The wheel releases a batch at the start of its tick, so wait out the remainder
+            delay = start + target - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            executed = time.monotonic() - start
+
+            try:
+                self._execute(device, actions)
+            except Exception as e:
+                logging.warn("Scheduled action failed on Hub {} : {}".format(device.key, e))
+                error = e
+
+            with lock:
+                for action in actions:
+                    results.append(ActionResult(device.key, action.action, action.ports, target, executed, executed - target, error))
+
+    def run(self):
+        """Execute the plan, blocking until every action has run.  Returns ActionResults in execution order."""
+        results = []
+        lock = threading.Lock()
+        wheel = TimerWheel(self.tick, slots=min(4096, max(64, int(self.duration / self.tick) + 2)))
+
+        ## Give the worker threads a moment to start before the first deadline
+        start = time.monotonic() + 0.01
+        self.started = start
+
+        for action in self.plan:
+            wheel.add(start + action.offset, action)
+
+        queues = {key:queue.Queue() for key in self.devices.keys()}
+        workers = []
+
+        for key, device in self.devices.items():
+            worker = threading.Thread(target=self._worker, args=(device, queues[key], start, results, lock), 
+                                      name="usbhub-scheduler-{}".format(key), daemon=True)
+            worker.start()
+            workers.append(worker)
+
+        while wheel.pending > 0:
+            now = time.monotonic()
+            batches = {}
+
+            for deadline, action in wheel.expire(now):
+                batches.setdefault(action.key, []).append((deadline, action))
+
+            for key, batch in batches.items():
+                target = batch[0][0] - start
+                queues[key].put((target, [action for _, action in batch]))
+
+            if wheel.pending > 0:
+                next_tick = (int(time.monotonic() / self.tick) + 1) * self.tick
+                time.sleep(max(0, next_tick - time.monotonic()))
+
+        for key in queues.keys():
+            queues[key].put(None)
+
+        for worker in workers:
+            worker.join()
+
+        return sorted(results, key=lambda result: result.executed)
+
+def jitter_report(results):
+    """Summarize the jitter (in seconds) of the ActionResults returned by PortScheduler.run."""
+    report = summarize(result.jitter for result in results)
+    report['errors'] = len([result for result in results if result.error is not None])
+
+    return report
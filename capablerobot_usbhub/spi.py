@@ -21,6 +21,7 @@
 # THE SOFTWARE.
 
 import logging
+import threading
 
 import usb.core
 import usb.util
@@ -35,11 +36,23 @@ class USBHubSPI(Lockable):
 
     REG_SPI_DATA  = 0x2310
 
-    def __init__(self, hub, enable=False, timeout=100):
+    ## Largest number of bytes the hub will clock in a single SPI transfer
+    MAX_TRANSFER = 256
+
+    def __init__(self, hub, enable=False, timeout=100, combine_writes=False, combine_latency=5):
         self.hub = hub
         self.enabled = False
         self.timeout = timeout
 
+        ## Write combining state.  When enabled, small writes are gathered into
+        ## a single transfer and sent when the buffer fills, before any read,
+        ## on an explicit flush, or once 'combine_latency' ms have passed.
+        self.combine_writes = combine_writes
+        self.combine_latency = float(combine_latency)/1000.0
+
+        self._pending = bytearray()
+        self._pending_timer = None
+
         if enable:
             self.enable()
 
@@ -74,6 +87,7 @@ class USBHubSPI(Lockable):
         if not self.enabled:
             return True
 
+        self.flush()
         self.acquire_lock()
 
         try:
@@ -88,6 +102,82 @@ class USBHubSPI(Lockable):
         self.release_lock()
         return True
 
+    def _debug_enabled(self):
+        ## Formatting every byte of a large buffer is expensive, so
+        ## only do it when the debug output will actually be emitted
+        return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    def _spi_write(self, data, clocks):
+        ## Caller must hold the lock.  'clocks' is the total number of bytes
+        ## the hub clocks on the bus, which is larger than len(data) when
+        ## bytes are to be read back after the write phase.
+        try:
+            return self.hub.handle.ctrl_transfer(REQ_OUT+1, self.CMD_SPI_WRITE, clocks, 0, data, timeout=self.timeout)
+        except usb.core.USBError:
+            raise OSError('Unable to perform SPI write')
+
+    def _spi_read(self, length):
+        ## Caller must hold the lock.  Returns data clocked in during the last write.
+
+        ## Need to offset the address for USB access
+        address = self.REG_SPI_DATA + self.hub.REG_BASE_ALT
+
+        ## Split 32 bit register address into the 16 bit value & index fields
+        value = address & 0xFFFF
+        index = address >> 16
+
+        data = self.hub.handle.ctrl_transfer(REQ_IN, self.hub.CMD_REG_READ, value, index, length, timeout=self.timeout)
+
+        if length != len(data):
+            raise OSError('Incorrect data length')
+
+        return data
+
+    def _write_chunks(self, buf, start, end):
+        ## Caller must hold the lock.  Buffers longer than the hub can accept
+        ## in one transfer are split into chunks, sent back-to-back.
+        total = 0
+
+        for pos in range(start, end, self.MAX_TRANSFER):
+            chunk = buf[pos:min(pos + self.MAX_TRANSFER, end)]
+            total += self._spi_write(chunk, len(chunk))
+
+        return total
+
+    def _flush_pending(self):
+        ## Caller must hold the lock.
+        if self._pending_timer is not None:
+            self._pending_timer.cancel()
+            self._pending_timer = None
+
+        if len(self._pending) == 0:
+            return 0
+
+        data = bytes(self._pending)
+        self._pending = bytearray()
+
+        return self._write_chunks(data, 0, len(data))
+
+    def _flush_expired(self):
+        ## Called from the latency timer thread
+        self.acquire_lock()
+
+        try:
+            self._flush_pending()
+        except OSError:
+            logging.warn("USB Error in SPI combined write")
+        finally:
+            self.release_lock()
+
+    def flush(self):
+        """Send any writes being held by write combining."""
+        self.acquire_lock()
+
+        try:
+            return self._flush_pending()
+        finally:
+            self.release_lock()
+
     def write(self, buf, start=0, end=None):
         if not self.enabled:
             self.enable()
@@ -98,19 +188,35 @@ class USBHubSPI(Lockable):
         if end is None:
             end = len(buf)
 
-        if start-end >= 256:
-            raise ValueError('SPI interface cannot write a buffer longer than 256 elements')
-            return False
+        if self._debug_enabled():
+            logging.debug("SPI Write : [{}]".format(" ".join([hex(v) for v in list(buf[start:end])])))
 
         self.acquire_lock()
 
-        logging.debug("SPI Write : [{}]".format(" ".join([hex(v) for v in list(buf[start:end])])))
+        try:
+            if not self.combine_writes:
+                return self._write_chunks(buf, start, end)
 
-        value = end - start
-        length = self.hub.handle.ctrl_transfer(REQ_OUT+1, self.CMD_SPI_WRITE, value, 0, buf[start:end], value, timeout=self.timeout)
+            length = end - start
 
-        self.release_lock()
-        return length
+            ## Send what has been gathered if this write would not fit alongside it
+            if len(self._pending) + length > self.MAX_TRANSFER:
+                self._flush_pending()
+
+            ## Writes which fill a transfer on their own gain nothing from combining
+            if length >= self.MAX_TRANSFER:
+                return self._write_chunks(buf, start, end)
+
+            self._pending.extend(buf[start:end])
+
+            if self._pending_timer is None:
+                self._pending_timer = threading.Timer(self.combine_latency, self._flush_expired)
+                self._pending_timer.daemon = True
+                self._pending_timer.start()
+
+            return length
+        finally:
+            self.release_lock()
 
     def readinto(self, buf, start=0, end=None, addr='', try_lock=True):
         if not self.enabled:
@@ -124,29 +230,55 @@ class USBHubSPI(Lockable):
 
         length = end - start 
 
-        ## Need to offset the address for USB access
-        address = self.REG_SPI_DATA + self.hub.REG_BASE_ALT
-
-        ## Split 32 bit register address into the 16 bit value & index fields
-        value = address & 0xFFFF
-        index = address >> 16
-
         if try_lock:
             self.acquire_lock()
 
-        data = list(self.hub.handle.ctrl_transfer(REQ_IN, self.hub.CMD_REG_READ, value, index, length, timeout=self.timeout))
-
-        if length != len(data):
+        try:
+            self._flush_pending()
+            data = self._spi_read(length)
+        finally:
             self.release_lock()
-            raise OSError('Incorrect data length')
 
         # 'readinto' the given buffer
-        for i in range(end-start):  
-            buf[start+i] = data[i]
-        
-        logging.debug("SPI Read [{}] : [{}]".format(" ".join([hex(v) for v in addr]), " ".join([hex(v) for v in list(data)])))
-        self.release_lock()
-        
+        buf[start:end] = data
+
+        if self._debug_enabled():
+            logging.debug("SPI Read [{}] : [{}]".format(" ".join([hex(v) for v in addr]), " ".join([hex(v) for v in list(data)])))
+
+    def _write_readinto(self, buffer_out, buffer_in, out_start, out_end, in_start, in_end):
+        ## Caller must hold the lock.
+        ##
+        ## The hub clocks out the written bytes, then clocks in the requested
+        ## number of bytes.  When both together exceed a single transfer, the
+        ## leading part of the output is sent as plain writes, and the input
+        ## is then collected in hub-sized chunks.  At least one output byte is
+        ## kept for the first combined transfer so it carries the write data.
+        pos = out_start
+        in_pos = in_start
+
+        ## Nothing to read back, but the output bytes must still be sent
+        if in_end <= in_start:
+            self._write_chunks(buffer_out, out_start, out_end)
+            return
+
+        while out_end - pos > 1 and (out_end - pos) + (in_end - in_start) > self.MAX_TRANSFER:
+            chunk = buffer_out[pos:min(pos + self.MAX_TRANSFER, out_end - 1)]
+            self._spi_write(chunk, len(chunk))
+            pos += len(chunk)
+
+        while in_pos < in_end:
+            chunk = buffer_out[pos:out_end]
+            count = min(self.MAX_TRANSFER - len(chunk), in_end - in_pos)
+
+            length = self._spi_write(chunk, len(chunk) + count)
+
+            if length != len(chunk):
+                raise OSError('Incorrect response in write_readinto')
+
+            buffer_in[in_pos:in_pos + count] = self._spi_read(count)
+
+            in_pos += count
+            pos = out_end
 
     def write_readinto(self, buffer_out, buffer_in, out_start=0, out_end=None, in_start=0, in_end=None):
         if not self.enabled:
@@ -161,23 +293,51 @@ class USBHubSPI(Lockable):
         if in_end is None:
             in_end = len(buffer_in)
 
-        in_length = in_end - in_start
-        out_length = out_end - out_start 
-        value = out_length + in_length
-
         self.acquire_lock()
 
         try:
-            length = self.hub.handle.ctrl_transfer(REQ_OUT+1, self.CMD_SPI_WRITE, value, 0, buffer_out[out_start:out_end], out_length, timeout=self.timeout)
-        except usb.core.USBError:
+            self._flush_pending()
+            self._write_readinto(buffer_out, buffer_in, out_start, out_end, in_start, in_end)
+        finally:
             self.release_lock()
-            raise OSError('Unable to setup SPI write_readinto')
 
-        if length != 1:
-            self.release_lock()
-            raise OSError('Incorrect response in write_readinto')
+        if self._debug_enabled():
+            logging.debug("SPI Read [{}] : [{}]".format(" ".join([hex(v) for v in list(buffer_out[out_start:out_end])]), " ".join([hex(v) for v in list(buffer_in[in_start:in_end])])))
+
+    def transfer_many(self, transactions):
+        """Run a sequence of independent SPI transactions under a single lock.
 
-        ## readinto will release the lock created here, and
-        ## we have not release it, so there is no need to grab a new one
-        self.readinto(buffer_in, start=in_start, end=in_end, addr=list(buffer_out[out_start:out_end]), try_lock=False)
+        Each transaction is a (buffer_out, buffer_in) pair.  buffer_in may be a 
+        writable buffer, an integer length (a bytearray is allocated), or None 
+        for a write-only transaction, which skips the readback transfer entirely.
+        Returns the list of input buffers (None for write-only transactions).
+        """
+        if not self.enabled:
+            self.enable()
+
+        results = []
+
+        ## The hub holds the bytes clocked in by the most recent write in a single
+        ## SPI data register, so the readback of one transaction has to complete
+        ## before the next transaction's write is issued.  What is saved here is the
+        ## per-call enable check, locking, and debug formatting.
+        self.acquire_lock()
+
+        try:
+            self._flush_pending()
+
+            for buffer_out, buffer_in in transactions:
+                if isinstance(buffer_in, int):
+                    buffer_in = bytearray(buffer_in)
+
+                if not buffer_in:
+                    self._write_chunks(buffer_out, 0, len(buffer_out))
+                    results.append(None)
+                    continue
+
+                self._write_readinto(buffer_out, buffer_in, 0, len(buffer_out), 0, len(buffer_in))
+                results.append(buffer_in)
+        finally:
+            self.release_lock()
 
+        return results
@@ -33,6 +33,9 @@ REQ_IN = usb.util.build_request_type(
     usb.util.CTRL_TYPE_VENDOR,
     usb.util.CTRL_RECIPIENT_DEVICE)
 
+## Logical port each physical port of the Hub IC is connected to
+PORT_MAP = ["port2", "port4", "port1", "port3"]
+
 
 class Lockable():
     _lock = threading.Lock()
@@ -106,6 +109,29 @@ def register_keys(parsed, sort=True):
 
 import math
 
+def percentile(ordered, fraction):
+    ## Nearest-rank percentile of an already sorted list
+    if len(ordered) == 0:
+        return None
+
+    idx = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[max(0, min(idx, len(ordered) - 1))]
+
+def summarize(values):
+    """Return a dict of min / max / mean / p99 / count of 'values' (None for each statistic when empty)."""
+    ordered = sorted(values)
+
+    if len(ordered) == 0:
+        return dict(min=None, max=None, mean=None, p99=None, count=0)
+
+    return dict(
+        min   = ordered[0],
+        max   = ordered[-1],
+        mean  = sum(ordered) / len(ordered),
+        p99   = percentile(ordered, 0.99),
+        count = len(ordered)
+    )
+
 class BitVector:
     def __init__(self, val):
         self._val = val
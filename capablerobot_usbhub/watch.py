@@ -0,0 +1,158 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import time
+from collections import namedtuple
+
+import usb.core
+
+from .events import PollingEventSource
+
+## A single changed field of a watched register.  For registers watched by raw
+## address & length (without a register definition), 'field' is None and 
+## 'old' / 'new' are the raw bytes.
+RegisterChange = namedtuple('RegisterChange', ['timestamp', 'key', 'name', 'addr', 'field', 'old', 'new'])
+
+_Entry = namedtuple('_Entry', ['addr', 'length', 'name', 'endian'])
+_Read = namedtuple('_Read', ['addr', 'length', 'entries'])
+
+def _fields(parsed):
+    if parsed is None:
+        return {}
+
+    return {key:value for key, value in parsed.body.items() if not key.startswith("_") and not key.startswith("reserved")}
+
+class RegisterWatch(PollingEventSource):
+    """Polls a set of Hub registers and emits a RegisterChange for each field that changes.
+
+    Registers are given by name ('port::connection'), by address, or as an 
+    (address, length) tuple.  Registers within 'merge_gap' bytes of each other
+    are fetched with a single read.  Raw bytes are compared before anything is
+    decoded, so unchanged registers cost nothing beyond the read.
+
+    Polling runs every 'interval' seconds after a change and backs off by 
+    'backoff' per idle poll, up to 'max_interval' seconds.
+    """
+
+    name = "usbhub-register-watch"
+
+    def __init__(self, devices, registers, interval=0.05, max_interval=1.0, backoff=1.5, merge_gap=4, queue_size=1024):
+        super().__init__(interval, queue_size=queue_size)
+
+        if not isinstance(devices, (list, tuple)):
+            devices = [devices]
+
+        self.devices = list(devices)
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self._plans = [self._plan(device, registers, merge_gap) for device in self.devices]
+        self._raw = [{} for _ in self.devices]
+        self._parsed = [{} for _ in self.devices]
+        self._current = interval
+
+    def _plan(self, device, registers, merge_gap):
+        entries = []
+
+        for register in registers:
+            if isinstance(register, str):
+                addr, bits, endian = device.main.find_register_by_name(register)
+                entries.append(_Entry(addr, bits // 8, register, endian))
+            elif isinstance(register, tuple):
+                addr, length = register
+                entries.append(_Entry(addr, length, None, 'big'))
+            else:
+                name = device.main.find_register_name_by_addr(register)
+                _, bits, endian = device.main.find_register_by_name(name)
+                entries.append(_Entry(register, bits // 8, name, endian))
+
+        entries.sort(key=lambda entry: entry.addr)
+        reads = []
+
+        for entry in entries:
+            if len(reads) > 0 and entry.addr <= reads[-1].addr + reads[-1].length + merge_gap:
+                last = reads[-1]
+                length = max(last.length, entry.addr + entry.length - last.addr)
+                reads[-1] = _Read(last.addr, length, last.entries + [entry])
+            else:
+                reads.append(_Read(entry.addr, entry.length, [entry]))
+
+        return reads
+
+    @property
+    def transfers(self):
+        """Number of register reads made by each poll."""
+        return sum(len(plan) for plan in self._plans)
+
+    def poll(self):
+        """Read every watched register once, emitting and returning the changes found."""
+        found = []
+
+        for idx, device in enumerate(self.devices):
+            for read in self._plans[idx]:
+                try:
+                    data = device.register_read_raw(read.addr, read.length)
+                except (usb.core.USBError, OSError, ValueError):
+                    logging.warn("USB Error in register watch")
+                    continue
+
+                timestamp = time.monotonic()
+
+                for entry in read.entries:
+                    offset = entry.addr - read.addr
+                    raw = bytes(data[offset:offset+entry.length])
+                    last = self._raw[idx].get(entry.addr)
+
+                    if raw == last:
+                        continue
+
+                    self._raw[idx][entry.addr] = raw
+
+                    if entry.name is None:
+                        if last is not None:
+                            found.append(RegisterChange(timestamp, device.key, None, entry.addr, None, last, raw))
+                        continue
+
+                    parsed = _fields(device.decode_register(entry.name, entry.addr, list(raw), entry.endian))
+                    previous = self._parsed[idx].get(entry.addr)
+                    self._parsed[idx][entry.addr] = parsed
+
+                    if previous is None:
+                        continue
+
+                    for field, value in parsed.items():
+                        if previous.get(field) != value:
+                            found.append(RegisterChange(timestamp, device.key, entry.name, entry.addr, field, previous.get(field), value))
+
+        for event in found:
+            self._emit(event)
+
+        return found
+
+    def _interval(self, events):
+        if len(events) > 0:
+            self._current = self.period
+        else:
+            self._current = min(self._current * self.backoff, self.max_interval)
+
+        return self._current
@@ -0,0 +1,262 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2019 Chris Osterwood for Capable Robot Components
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections
+import logging
+import time
+from collections import namedtuple
+
+import usb.core
+
+from .events import PollingEventSource
+from .util import *
+
+## Alerts which count as a fault of a port by default
+FAULTS = ['OVER_LIMIT', 'ERROR', 'BACK_BIAS']
+
+## 'kind' is one of 'fault', 'power_off', 'power_on', 'disabled' or 'escalated'.  'alerts' 
+## is the list of fault names seen on the port, 'count' the number of faults within the 
+## policy window, and 'latency' the seconds from the alert read to the action completing.
+WatchdogEvent = namedtuple('WatchdogEvent', ['timestamp', 'key', 'port', 'kind', 'alerts', 'count', 'latency'])
+
+class RecoveryPolicy:
+    """How the watchdog reacts to faults on a port.
+
+    'action' is 'cycle' (power off, then back on after 'off_time' seconds, 
+    multiplied by 'backoff' for each further fault within 'window' seconds, up
+    to 'max_off_time'), 'disable' (power off and leave off), or 'none' (only 
+    count).  After 'disable_after' faults within 'window' seconds the port is 
+    left off, and 'escalate(event)' is called if given.
+    """
+
+    ACTIONS = ['cycle', 'disable', 'none']
+
+    def __init__(self, action='cycle', off_time=0.5, backoff=2.0, max_off_time=30.0, 
+                 disable_after=5, window=60.0, escalate=None):
+        if action not in self.ACTIONS:
+            raise ValueError("Action must be one of {}".format(", ".join(self.ACTIONS)))
+
+        self.action = action
+        self.off_time = off_time
+        self.backoff = backoff
+        self.max_off_time = max_off_time
+        self.disable_after = disable_after
+        self.window = window
+        self.escalate = escalate
+
+    def off_time_for(self, count):
+        return min(self.off_time * (self.backoff ** max(0, count - 1)), self.max_off_time)
+
+class PowerWatchdog(PollingEventSource):
+    """Polls the power alerts of a Hub and recovers ports which fault.
+
+    Each poll is the two block reads of 'power.alerts()', and the 48 bit alert 
+    mask is compared before any names are decoded, so an idle watchdog costs 
+    nothing beyond those reads.  A fault is counted when one of 'faults' newly 
+    asserts on a port, and is then handled by the RecoveryPolicy of that port 
+    ('policy' is one RecoveryPolicy, or a dict of them keyed by port).
+
+    Fault counts are in 'counters', recent WatchdogEvents in 'history', and 
+    'latency_stats' reports the time from reading an alert to acting on it.
+    """
+
+    name = "usbhub-power-watchdog"
+
+    def __init__(self, device, policy=None, rate=20, faults=FAULTS, history=256, queue_size=1024):
+        super().__init__(1.0 / float(rate), queue_size=queue_size)
+
+        self.device = device
+        self.faults = list(faults)
+
+        if policy is None:
+            policy = RecoveryPolicy()
+
+        if isinstance(policy, dict):
+            self.policies = {port:policy.get(port, RecoveryPolicy()) for port in [1,2,3,4]}
+        else:
+            self.policies = {port:policy for port in [1,2,3,4]}
+
+        ## Total faults per port, by alert name
+        self.counters = {port:collections.Counter() for port in [1,2,3,4]}
+        self.history = collections.deque(maxlen=history)
+        self.latencies = collections.deque(maxlen=history)
+
+        self._mask = 0
+        self._active = {port:set() for port in [1,2,3,4]}
+        self._recent = {port:collections.deque() for port in [1,2,3,4]}
+
+        ## Port -> time.monotonic() at which a power cycled port is turned back on
+        self._restore = {}
+        self.disabled = set()
+
+    def _port_faults(self, alerts, port):
+        out = set()
+
+        for name in alerts.port(port):
+            if name.split(".")[0] in self.faults:
+                out.add(name.split(".")[0])
+
+        return out
+
+    def _record(self, now, port, kind, alerts, count, latency=None):
+        event = WatchdogEvent(now, self.device.key, port, kind, sorted(alerts), count, latency)
+        self.history.append(event)
+
+        if latency is not None:
+            self.latencies.append(latency)
+
+        return event
+
+    def _handle(self, read_at, port, new):
+        found = []
+        policy = self.policies[port]
+        recent = self._recent[port]
+
+        now = time.monotonic()
+        recent.append(now)
+
+        while len(recent) > 0 and now - recent[0] > policy.window:
+            recent.popleft()
+
+        for name in new:
+            self.counters[port][name] += 1
+
+        count = len(recent)
+        found.append(self._record(now, port, 'fault', new, count))
+
+        if policy.action == 'none' and count < policy.disable_after:
+            logging.warn("Hub {} port {} fault {} ({} in {:.0f} s)".format(self.device.key, port, ", ".join(sorted(new)), count, policy.window))
+            return found
+
+        ## The port is turned off before anything else (including logging), to keep reaction latency low
+        self.device.power.disable([port])
+        done = time.monotonic()
+
+        logging.warn("Hub {} port {} fault {} ({} in {:.0f} s)".format(self.device.key, port, ", ".join(sorted(new)), count, policy.window))
+
+        if policy.action == 'disable' or count >= policy.disable_after:
+            self.disabled.add(port)
+            self._restore.pop(port, None)
+
+            event = self._record(done, port, 'disabled', new, count, done - read_at)
+            found.append(event)
+
+            if policy.escalate is not None and count >= policy.disable_after:
+                try:
+                    policy.escalate(event)
+                except Exception:
+                    logging.exception("Watchdog escalation failed")
+
+                found.append(self._record(time.monotonic(), port, 'escalated', new, count))
+        else:
+            self._restore[port] = done + policy.off_time_for(count)
+            found.append(self._record(done, port, 'power_off', new, count, done - read_at))
+
+        return found
+
+    def _restore_ports(self):
+        found = []
+        now = time.monotonic()
+
+        for port, when in sorted(self._restore.items()):
+            if when > now:
+                continue
+
+            del self._restore[port]
+            self.device.power.enable([port])
+
+            ## Faults still asserted once the port is back on count again
+            self._active[port] = set()
+            self._mask = None
+
+            found.append(self._record(time.monotonic(), port, 'power_on', [], len(self._recent[port])))
+
+        return found
+
+    def poll(self):
+        found = []
+
+        try:
+            found += self._restore_ports()
+
+            read_at = time.monotonic()
+            alerts = self.device.power.alerts()
+        except (usb.core.USBError, OSError) as e:
+            logging.warn("Watchdog could not read alerts of Hub {} : {}".format(self.device.key, e))
+            return self._emit_all(found)
+
+        if alerts.mask == self._mask:
+            return self._emit_all(found)
+
+        self._mask = alerts.mask
+
+        for port in [1,2,3,4]:
+            active = self._port_faults(alerts, port)
+
+            ## Ports which are off (waiting to be cycled or disabled) are not re-counted
+            new = active - self._active[port]
+            self._active[port] = active
+
+            if len(new) == 0 or port in self.disabled or port in self._restore:
+                continue
+
+            try:
+                found += self._handle(read_at, port, new)
+            except (usb.core.USBError, OSError) as e:
+                logging.warn("Watchdog could not act on Hub {} port {} : {}".format(self.device.key, port, e))
+
+        return self._emit_all(found)
+
+    def _emit_all(self, found):
+        for event in found:
+            self._emit(event)
+
+        return found
+
+    def _interval(self, events):
+        ## Wake up in time for the next scheduled power on
+        if len(self._restore) > 0:
+            return max(0, min(self.period, min(self._restore.values()) - time.monotonic()))
+
+        return self.period
+
+    def rearm(self, ports=[1,2,3,4], enable=True):
+        """Clear fault history of the given ports, optionally turning disabled ports back on."""
+        for port in ports:
+            self._recent[port].clear()
+            self._active[port] = set()
+
+            if port in self.disabled:
+                self.disabled.discard(port)
+
+                if enable:
+                    self.device.power.enable([port])
+
+        self._mask = None
+
+    def reset_counters(self):
+        for port in [1,2,3,4]:
+            self.counters[port].clear()
+
+    def latency_stats(self):
+        """Return min / max / mean / p99 of the seconds from alert read to port action."""
+        return summarize(self.latencies)
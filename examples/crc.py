@@ -0,0 +1,71 @@
+import os, sys, inspect
+import random
+import timeit
+
+lib_folder = os.path.join(os.path.split(inspect.getfile( inspect.currentframe() ))[0], '..')
+lib_load = os.path.realpath(os.path.abspath(lib_folder))
+
+if lib_load not in sys.path:
+    sys.path.insert(0, lib_load)
+
+from capablerobot_usbhub.config import _CRC8_INIT, _CRC8_POLYNOMIAL, _CRC8_TABLE, \
+    _generate_crc, _generate_crc_bitwise, _encode_frame, _decode_frame
+
+## Checks the table-driven mailbox CRC against the bitwise reference and times
+## frame encoding & decoding.  Runs without a Hub attached.
+
+def crc_step(state, byte):
+    ## Independent bitwise update from an arbitrary CRC state
+    crc = state ^ byte
+    for _ in range(8):
+        crc = ((crc << 1) ^ _CRC8_POLYNOMIAL) if crc & 0x80 else (crc << 1)
+    return crc & 0xFF
+
+def old_frame(cmd, name_addr, value):
+    ## Frame building as done before the CRC table was introduced
+    data = [cmd << 5 | name_addr, (value >> 8) & 0xFF, value & 0xFF]
+    return data + [_generate_crc_bitwise(data)]
+
+## Every (CRC state, input byte) pair
+for state in range(256):
+    for byte in range(256):
+        assert _CRC8_TABLE[state ^ byte] == crc_step(state, byte), (state, byte)
+
+print("CRC table matches bitwise update for all 65536 (state, byte) pairs")
+
+rng = random.Random(0)
+
+for _ in range(200000):
+    data = [rng.randrange(256) for _ in range(rng.randint(1, 4))]
+    assert _generate_crc(data) == _generate_crc_bitwise(data), data
+
+print("_generate_crc matches _generate_crc_bitwise for 200000 random buffers")
+
+## Every header byte (command & name address) with every value of one byte
+## and a random other byte, checking round trips and CRC rejection
+frames = 0
+for head in range(256):
+    cmd, name_addr = head >> 5, head & 0b11111
+
+    for byte in range(256):
+        for value in [byte << 8 | rng.randrange(256), rng.randrange(256) << 8 | byte]:
+            frame = _encode_frame(cmd, name_addr, value)
+            assert list(frame) == old_frame(cmd, name_addr, value)
+            assert _decode_frame(frame) == (cmd, name_addr, value)
+
+            corrupt = frame[0:3] + bytes([frame[3] ^ (1 << rng.randrange(8))])
+            assert _decode_frame(corrupt) is None
+            frames += 1
+
+print("{} frames encode identically, round trip, and reject a corrupted CRC".format(frames))
+
+count = 200000
+frame = _encode_frame(1, 7, 0x1234)
+
+for label, statement in [
+    ("old frame build", lambda: old_frame(1, 7, 0x1234)),
+    ("_encode_frame", lambda: _encode_frame(1, 7, 0x1234)),
+    ("_decode_frame", lambda: _decode_frame(frame)),
+]:
+    elapsed = min(timeit.repeat(statement, number=count, repeat=5))
+    print("{:>16} : {:6.3f} us".format(label, elapsed / count * 1e6))
@@ -0,0 +1,39 @@
+import os, sys, inspect
+import time
+
+lib_folder = os.path.join(os.path.split(inspect.getfile( inspect.currentframe() ))[0], '..')
+lib_load = os.path.realpath(os.path.abspath(lib_folder))
+
+if lib_load not in sys.path:
+    sys.path.insert(0, lib_load)
+
+import capablerobot_usbhub 
+from capablerobot_usbhub.config import POLLING_FIXED, POLLING_ADAPTIVE
+
+hub = capablerobot_usbhub.USBHub()
+
+if hub.config.version < 2:
+    print("Hub firmware does not use the config mailbox for measurements")
+    sys.exit(0)
+
+## Compare the fixed 100 ms polling used by earlier releases with adaptive polling
+for label, polling in [("fixed", POLLING_FIXED), ("adaptive", POLLING_ADAPTIVE)]:
+    result = hub.config.measure_turnaround(name="power_measure_12", count=20, polling=polling)
+    print(label.rjust(10), " ".join(["{} {:7.2f} ms".format(key, value*1000) for key, value in result.items()]))
+
+start = time.monotonic()
+hub.power.measurements()
+print("power.measurements() took {:.2f} ms".format((time.monotonic() - start)*1000))
+
+## Profile mailbox latency across firmware loop_delay values.  The original 
+## value is restored afterwards, pass apply=True to keep the recommendation.
+result = hub.config.tune_loop_delay()
+
+for entry in result["profile"]:
+    if "median" in entry:
+        print("loop_delay {:>3} : median {:7.2f} ms  jitter {:6.2f} ms  {}".format(
+            entry["loop_delay"], entry["median"]*1000, entry["jitter"]*1000, "stable" if entry["stable"] else "unstable"))
+    else:
+        print("loop_delay {:>3} : {}".format(entry["loop_delay"], entry["error"]))
+
+print("Recommended loop_delay : {} (currently {})".format(result["recommended"], result["original"]))
@@ -0,0 +1,48 @@
+import os, sys, inspect
+import time
+
+lib_folder = os.path.join(os.path.split(inspect.getfile( inspect.currentframe() ))[0], '..')
+lib_load = os.path.realpath(os.path.abspath(lib_folder))
+
+if lib_load not in sys.path:
+    sys.path.insert(0, lib_load)
+
+import capablerobot_usbhub 
+
+## Wraps the pyusb device handle to count USB control transfers
+class CountingHandle:
+    def __init__(self, handle):
+        self._handle = handle
+        self.transfers = 0
+
+    def ctrl_transfer(self, *args, **kwargs):
+        self.transfers += 1
+        return self._handle.ctrl_transfer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._handle, name)
+
+hub = capablerobot_usbhub.USBHub()
+device = hub.device
+device.handle = CountingHandle(device.handle)
+
+def measure(label, function):
+    device.handle.transfers = 0
+    start = time.monotonic()
+    function()
+    elapsed = time.monotonic() - start
+    print("{:>12} : {:4d} transfers {:8.2f} ms".format(label, device.handle.transfers, elapsed*1000))
+
+def individual():
+    device.connections()
+    device.speeds()
+    device.data_state()
+    device.power.state()
+    device.power.measurements()
+    device.power.limits()
+
+measure("individual", individual)
+measure("port_status", device.port_status)
+
+for status in device.port_status():
+    print(status)
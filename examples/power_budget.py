@@ -0,0 +1,73 @@
+import os, sys, inspect
+import time
+
+lib_folder = os.path.join(os.path.split(inspect.getfile( inspect.currentframe() ))[0], '..')
+lib_load = os.path.realpath(os.path.abspath(lib_folder))
+
+if lib_load not in sys.path:
+    sys.path.insert(0, lib_load)
+
+import capablerobot_usbhub 
+
+from capablerobot_usbhub.budget import PowerBudget
+
+## Stand-in for USBHubPower which models each port as a load whose draw is 
+## clamped by the port's current limit.  This allows the budget controller 
+## to be exercised without hardware attached.
+class SimulatedPower:
+    def __init__(self, demand):
+        self.demand = list(demand)
+        self.enabled = [True] * 4
+        self._limits = [2670] * 4
+
+    def measurements(self, ports=[1,2,3,4]):
+        return [min(self.demand[p-1], self._limits[p-1]) if self.enabled[p-1] else 0 for p in ports]
+
+    def state(self, ports=[1,2,3,4]):
+        return [self.enabled[p-1] for p in ports]
+
+    def limits(self):
+        return list(self._limits)
+
+    def set_limits(self, ports, limit):
+        for port in ports:
+            self._limits[port-1] = limit
+
+    def enable(self, ports=[]):
+        for port in ports:
+            self.enabled[port-1] = True
+
+    def disable(self, ports=[]):
+        for port in ports:
+            self.enabled[port-1] = False
+
+class SimulatedHub:
+    def __init__(self, key, demand):
+        self.key = key
+        self.power = SimulatedPower(demand)
+
+hubs = [SimulatedHub("SIM{}".format(idx), [400, 700, 500, 300]) for idx in range(4)]
+
+## Port 1 of every Hub is critical and is never the first to be shed
+priorities = {(hub.key, 1):10 for hub in hubs}
+
+budget = PowerBudget(hubs, budget=8000, priorities=priorities, policy='both', hold=0.5)
+
+now = 0.0
+for step in range(60):
+    ## Every port 2 load surges
+    if step == 10:
+        for hub in hubs:
+            hub.power.demand[1] = 2500
+
+    ## Then drops, allowing limits to be restored
+    if step == 25:
+        for hub in hubs:
+            hub.power.demand[1] = 300
+
+    for decision in budget.step(now):
+        print("{:5.1f} s {:>10} {} port {} -> {} (total {:.0f} mA)".format(now, decision.action, decision.key, decision.port, decision.value, decision.total))
+
+    now += 0.2
+
+print("Final total {:.0f} mA of {:.0f} mA budget".format(budget.total, budget.budget))